@@ -1,26 +1,39 @@
 \
+import io
 import os
+import importlib.util
+import re
 import ssl
 import sys
 import time
 import json
+import struct
 import uuid
 import queue
 import signal
+import socket
+import wave
+import selectors
+import hashlib
+import mmap
+import bisect
 import logging
 import threading
+import heapq
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait
 import numpy as np
 import yaml
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple, Union
 
-import sounddevice as sd
-import webrtcvad
-import pvporcupine
-from paho.mqtt import client as mqtt
-from faster_whisper import WhisperModel
+# sounddevice, webrtcvad, pvporcupine, paho, faster_whisper och soundfile importeras i
+# klasserna som använder dem, så att --check-config och bench-stubbar startar
+# utan att ladda de tunga/native biblioteken
 from datetime import datetime, timezone
 from pathlib import Path
-from subprocess import Popen, PIPE, CalledProcessError, run
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
 
 def load_config(path: str) -> dict:
     """Load and validate configuration from YAML file."""
@@ -52,13 +65,155 @@ def load_config(path: str) -> dict:
 def utc_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
+def sd_notify(state: str) -> bool:
+    """Send a systemd notification such as ``READY=1``; no-op outside systemd."""
+    addr = os.environ.get("NOTIFY_SOCKET")
+    if not addr:
+        return False
+    if addr.startswith("@"):
+        # Abstrakt socket-namnrymd
+        addr = "\0" + addr[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(addr)
+            sock.sendall(state.encode())
+        return True
+    except OSError as e:
+        logging.warning(f"sd_notify misslyckades: {e}")
+        return False
+
+# Meningsgräns: skiljetecken följt av blanksteg och versal/siffra/citattecken
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+(?=[\"'“(\dA-ZÅÄÖÉ])")
+# Samma gräns, eller radbrytning, i text som strömmas in bit för bit
+_SENTENCE_BOUNDARY_RE = re.compile(_SENTENCE_SPLIT_RE.pattern + r"|\n+")
+# En bit som slutar med skiljetecken och blanksteg avslutar en mening
+_SENTENCE_END_RE = re.compile(r"[.!?…][\"'”»)]*\s+$")
+
+def iter_sentences(text_chunks):
+    """Yield complete sentences from an iterable of text chunks.
+
+    A sentence is emitted once the start of the next one, a line break or a
+    chunk ending in punctuation and whitespace has arrived.
+    """
+    pending = ""
+    for chunk in text_chunks:
+        pending += chunk
+        cut = None
+        if _SENTENCE_END_RE.search(pending):
+            cut = len(pending)
+        else:
+            for m in _SENTENCE_BOUNDARY_RE.finditer(pending):
+                cut = m.end()
+        if cut:
+            for sentence in split_sentences(pending[:cut]):
+                yield sentence
+            pending = pending[cut:]
+    for sentence in split_sentences(pending):
+        yield sentence
+
+def split_sentences(text: str) -> list:
+    """Split reply text into sentences for pipelined TTS.
+
+    Each sentence is returned on a single line since Piper reads one
+    utterance per line.
+    """
+    sentences = []
+    for paragraph in text.splitlines():
+        paragraph = " ".join(paragraph.split())
+        if paragraph:
+            sentences.extend(s for s in _SENTENCE_SPLIT_RE.split(paragraph) if s)
+    return sentences
+
+class RequestSpooled(ConnectionError):
+    """The broker was unreachable; the request was stored for later delivery."""
+
+class RequestSpool:
+    """Durable on-disk queue for requests made while MQTT is down.
+
+    SQLite in WAL mode, keyed on corr_id so a request is stored at most once.
+    Entries older than ``max_age_sec`` are dropped instead of being sent, and
+    the queue never holds more than ``max_items`` (oldest go first).
+    """
+
+    def __init__(self, spool_cfg: Dict[str, Any]):
+        self.enabled = bool(spool_cfg.get("enabled", False))
+        self.max_age = float(spool_cfg.get("max_age_sec", 600))
+        self.max_items = int(spool_cfg.get("max_items", 200))
+        self._lock = threading.Lock()
+        self._db = None
+        if not self.enabled:
+            return
+        path = spool_cfg.get("path", "resources/spool.db")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Anropas från både appens trådar och flush-tråden, därav låset
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS spool ("
+                         "corr_id TEXT PRIMARY KEY, topic TEXT NOT NULL, payload BLOB NOT NULL, "
+                         "qos INTEGER NOT NULL, created REAL NOT NULL)")
+        queued = len(self)
+        if queued:
+            logging.info(f"{queued} köade requests från förra körningen")
+
+    def add(self, corr_id: str, topic: str, payload: str, qos: int) -> bool:
+        if self._db is None:
+            return False
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO spool VALUES (?, ?, ?, ?, ?)",
+                             (corr_id, topic, payload, qos, time.time()))
+            self._db.execute("DELETE FROM spool WHERE corr_id NOT IN "
+                             "(SELECT corr_id FROM spool ORDER BY created DESC LIMIT ?)", (self.max_items,))
+        return True
+
+    def pending(self) -> List[Tuple[str, str, bytes, int]]:
+        """Drop expired entries and return the rest, oldest first."""
+        if self._db is None:
+            return []
+        with self._lock:
+            expired = self._db.execute("DELETE FROM spool WHERE created < ?",
+                                       (time.time() - self.max_age,)).rowcount
+            rows = self._db.execute("SELECT corr_id, topic, payload, qos FROM spool ORDER BY created").fetchall()
+        if expired:
+            logging.info(f"Kastade {expired} köade requests äldre än {self.max_age:.0f} s")
+        return rows
+
+    def remove(self, corr_ids: List[str]):
+        if self._db is None or not corr_ids:
+            return
+        with self._lock:
+            self._db.executemany("DELETE FROM spool WHERE corr_id = ?", [(c,) for c in corr_ids])
+
+    def __len__(self) -> int:
+        if self._db is None:
+            return 0
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
 class MqttClient:
-    def __init__(self, cfg):
+    # CONNACK-koder då brokern finns men inte kan ta emot oss just nu (MQTT 3 och 5)
+    TRANSIENT_CONNACK = (3, 136, 137)
+
+    def __init__(self, cfg, client=None):
+        """``client`` replaces the paho client, e.g. with a local loopback
+        responder for benchmarks."""
         self.cfg = cfg
+        self._init_state()
+        if client is not None:
+            self.client = client
+            return
         
         # Get clean_session parameter from config (default to True for MQTTv311)
         clean_session = bool(cfg.get("clean_session", True))
-        
+
+        from paho.mqtt import client as mqtt
         self.client = mqtt.Client(
             callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
             client_id=cfg["client_id"],
@@ -96,16 +251,27 @@ class MqttClient:
                 tls_version=ssl.PROTOCOL_TLS_CLIENT,
             )
         self.client.tls_insecure_set(bool(cfg.get("tls_insecure", False)))
+        # paho:s egen loop-tråd återansluter med exponentiell backoff utan att blockera
+        self.client.reconnect_delay_set(min_delay=1, max_delay=int(cfg.get("reconnect_max_delay_sec", 60)))
 
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
 
+    def _init_state(self):
+        # Styrmeddelanden (t.ex. nytt STT-ordförråd) skickas hit från paho-tråden
+        self.control_topic = self.cfg.get("control_topic")
+        self.on_control = None
+        # corr_id -> PendingRequest; används från både paho-tråden och appens trådar
         self.pending = {}
+        self._pending_lock = threading.Lock()
+        self._deadlines = DeadlineTimer(self._expire)
         self._connected_evt = threading.Event()
-        self._reconnect_lock = threading.Lock()
         self._connection_attempts = 0
-        self._max_reconnect_attempts = 5
+        # Senaste CONNACK-koden; None tills brokern svarat
+        self._connack_rc = None
+        self.spool = RequestSpool(self.cfg.get("spool", {}) or {})
+        self._flush_lock = threading.Lock()
 
     def connect(self):
         """Connect to MQTT broker with retry logic."""
@@ -117,6 +283,7 @@ class MqttClient:
         
         max_attempts = 3
         for attempt in range(max_attempts):
+            self._connack_rc = None
             try:
                 self.client.connect(host, port, keepalive=keepalive)
                 self.client.loop_start()
@@ -126,20 +293,39 @@ class MqttClient:
                         time.sleep(2)
                         continue
                     raise RuntimeError("MQTT: anslutning misslyckades (timeout)")
-                
-                base = self.cfg["base_response_topic"].rstrip("/")
-                topic = f"{base}/#"
-                self.client.subscribe(topic, qos=self.cfg.get("qos", 1))
-                logging.info(f"Prenumererar på: {topic}")
                 self._connection_attempts = 0
                 return
             except Exception as e:
+                if self._refused(e):
+                    # Fel inloggning eller certifikat blir inte bättre av offlineläge
+                    self.client.loop_stop()
+                    raise RuntimeError(f"MQTT: anslutningen nekades: {e}")
                 if attempt < max_attempts - 1:
                     logging.warning(f"MQTT anslutningsfel: {e}, försöker igen ({attempt + 1}/{max_attempts})...")
                     time.sleep(2)
+                elif self.spool.enabled:
+                    # Starta ändå; requests köas på disk tills loop-tråden fått kontakt
+                    logging.warning(f"MQTT: anslutning misslyckades ({e}), startar offline och återansluter i bakgrunden")
+                    self.client.connect_async(host, port, keepalive=keepalive)
+                    self.client.loop_start()
                 else:
                     raise RuntimeError(f"MQTT: anslutning misslyckades efter {max_attempts} försök: {e}")
 
+    def _refused(self, error: Exception) -> bool:
+        """True if the broker or TLS handshake rejected us, not just unreachable."""
+        if isinstance(error, ssl.SSLError):
+            return True
+        return self._connack_rc not in (None, 0) and self._connack_rc not in self.TRANSIENT_CONNACK
+
+    def _subscribe(self):
+        base = self.cfg["base_response_topic"].rstrip("/")
+        topic = f"{base}/#"
+        self.client.subscribe(topic, qos=self.cfg.get("qos", 1))
+        logging.info(f"Prenumererar på: {topic}")
+        if self.control_topic:
+            self.client.subscribe(self.control_topic, qos=self.cfg.get("qos", 1))
+            logging.info(f"Prenumererar på styrkanal: {self.control_topic}")
+
     def close(self):
         try:
             self.client.loop_stop()
@@ -147,15 +333,21 @@ class MqttClient:
             logging.info("MQTT-anslutning stängd.")
         except Exception as e:
             logging.warning(f"Fel vid stängning av MQTT: {e}")
+        self.spool.close()
 
     def _on_connect(self, client, userdata, flags, reason_code, properties):
         # Convert ReasonCode object to int for comparisons and dict lookups
         rc = reason_code.value if hasattr(reason_code, 'value') else reason_code
+        self._connack_rc = rc
         
         if rc == 0:
             logging.info("MQTT ansluten.")
+            # Prenumerera här så att det görs om efter varje återanslutning
+            self._subscribe()
             self._connected_evt.set()
             self._connection_attempts = 0
+            if len(self.spool):
+                threading.Thread(target=self._flush_spool, name="mqtt-spool", daemon=True).start()
         else:
             # Provide more helpful error messages based on reason code
             error_messages = {
@@ -180,15 +372,10 @@ class MqttClient:
         logging.warning(f"MQTT frånkopplad: reason_code={rc}")
         self._connected_evt.clear()
         
-        # Automatic reconnection for unexpected disconnects
+        # Återanslutning sköts av paho:s loop-tråd (reconnect_delay_set); sov inte här
         if rc != 0:
-            with self._reconnect_lock:
-                self._connection_attempts += 1
-                if self._connection_attempts <= self._max_reconnect_attempts:
-                    logging.info(f"Försöker återansluta till MQTT (försök {self._connection_attempts}/{self._max_reconnect_attempts})...")
-                    time.sleep(2 ** self._connection_attempts)  # Exponential backoff
-                else:
-                    logging.error("Max antal återanslutningsförsök nått. Ger upp.")
+            self._connection_attempts += 1
+            logging.info(f"MQTT återansluter i bakgrunden (avbrott {self._connection_attempts})")
 
     def _on_message(self, client, userdata, message):
         try:
@@ -201,74 +388,881 @@ class MqttClient:
             logging.exception(f"Oväntat fel vid avkodning av MQTT-meddelande: {e}")
             return
 
+        if self.control_topic and message.topic == self.control_topic:
+            if self.on_control is not None:
+                try:
+                    self.on_control(data)
+                except Exception as e:
+                    logging.exception(f"Fel vid hantering av styrmeddelande: {e}")
+            return
+
         corr_id = data.get("corr_id") or data.get("correlation_id")
         if not corr_id:
             logging.warning("MQTT-svar saknar corr_id")
             return
 
-        q = self.pending.get(corr_id)
-        if q:
-            q.put(data)
+        with self._pending_lock:
+            req = self.pending.get(corr_id)
+            if req is None:
+                return
+            req.fut.acked.set()
+            if data.get("ack"):
+                # Fjärr-STT kvitterar ljudet, ev. med transkriptet, innan svaret kommer
+                if data.get("transcript"):
+                    req.fut.text = data["transcript"]
+                req.deadline = time.monotonic() + req.timeout
+                self._deadlines.add(req.deadline, corr_id)
+                return
+            done = req.accept(data)
+            if done:
+                self.pending.pop(corr_id, None)
+            else:
+                # Varje delsvar förlänger tidsgränsen
+                req.deadline = time.monotonic() + req.timeout
+                self._deadlines.add(req.deadline, corr_id)
+        if done:
+            req.resolve()
 
-    def request_reply(self, text: str, lang: str, qos: int = 1, timeout: int = 15) -> Optional[Dict[str, Any]]:
-        """Send request to n8n workflow and wait for response."""
-        if not self._connected_evt.is_set():
-            logging.error("MQTT inte ansluten, kan inte skicka request")
-            return None
-        
-        corr_id = str(uuid.uuid4())
+    def submit(self, text: Optional[str], lang: str, qos: int = 1, timeout: float = 15, on_chunk=None,
+               topic: Optional[str] = None, session_id: Optional[str] = None,
+               audio: Optional[Dict[str, Any]] = None, corr_id: Optional[str] = None) -> "RequestFuture":
+        """Publish a request (text, or ``audio`` for server-side STT) and return a RequestFuture.
+        ``on_chunk`` receives streamed reply chunks; ``corr_id`` reuses the id of an abandoned upload."""
+        corr_id = corr_id or str(uuid.uuid4())
         base = self.cfg["base_response_topic"].rstrip("/")
         reply_topic = f"{base}/{corr_id}"
-
-        q = queue.Queue()
-        self.pending[corr_id] = q
+        fut = RequestFuture(corr_id, text, lang, topic)
 
         payload = {
-            "text": text,
             "lang": lang,
             "timestamp": utc_iso(),
             "corr_id": corr_id,
             "reply_topic": reply_topic,
             "source": "genio-ai-rpi5"
         }
-        
+        if on_chunk is not None:
+            payload["stream"] = True
+        if session_id is not None:
+            payload["session_id"] = session_id
+        if audio is None:
+            payload["text"] = text
+            req_topic = topic or self.cfg["request_topic"]
+        else:
+            payload["codec"] = audio["codec"]
+            payload["sample_rate"] = audio["sample_rate"]
+            if topic:
+                # Servern skickar vidare texten dit nyckelordet styr frågan
+                payload["request_topic"] = topic
+            req_topic = audio["topic"]
+
+        if not self._connected_evt.is_set():
+            self._spool_or_fail(fut, req_topic, payload, qos, audio, ConnectionError("MQTT inte ansluten"))
+            return fut
+
+        req = PendingRequest(fut, timeout, on_chunk)
+        with self._pending_lock:
+            self.pending[corr_id] = req
+        fut.add_done_callback(lambda f: self._forget(corr_id, req))
+
         try:
-            req_topic = self.cfg["request_topic"]
-            result = self.client.publish(req_topic, json.dumps(payload), qos=qos, retain=False)
-            if result.rc != mqtt.MQTT_ERR_SUCCESS:
-                logging.error(f"MQTT publish misslyckades: rc={result.rc}")
-                return None
-            
-            logging.info(f"Skickade MQTT-request -> {req_topic} (corr_id={corr_id})")
+            body = json.dumps(payload) if audio is None else pack_audio_payload(payload, audio["data"])
+            result = self.client.publish(req_topic, body, qos=qos, retain=False)
+            if result.rc != 0:  # MQTT_ERR_SUCCESS
+                raise ConnectionError(f"MQTT publish misslyckades: rc={result.rc}")
+        except ConnectionError as e:
+            self._spool_or_fail(fut, req_topic, payload, qos, audio, e)
+            return fut
+        except Exception as e:
+            if fut.set_running_or_notify_cancel():
+                fut.set_exception(e)
+            return fut
+
+        self._deadlines.add(req.deadline, corr_id)
+        logging.info(f"Skickade MQTT-request -> {req_topic} (corr_id={corr_id})")
+        return fut
+
+    def _spool_or_fail(self, fut: "RequestFuture", topic: str, payload: Dict[str, Any], qos: int,
+                       audio: Optional[Dict[str, Any]], err: Exception):
+        """Store a text request for later delivery, or fail it with ``err``.
+
+        Either way the Future fails now: a spooled request is delivered when
+        the broker is back, but its reply is no longer waited for.
+        """
+        # Ljuduppladdningar köas inte; där faller turen tillbaka på lokal STT
+        if audio is None and self.spool.add(payload["corr_id"], topic, json.dumps(dict(payload, spooled=True)), qos):
+            logging.warning(f"MQTT inte ansluten, request köad på disk (corr_id={payload['corr_id']}, "
+                            f"{len(self.spool)} i kön)")
+            err = RequestSpooled(f"Request köad: {payload['corr_id']}")
+        if fut.set_running_or_notify_cancel():
+            fut.set_exception(err)
+
+    def _flush_spool(self):
+        """Publish spooled requests after a reconnect (own thread, not paho's)."""
+        with self._flush_lock:
+            rows = self.spool.pending()
+            if not rows:
+                return
+            sent = []
+            for corr_id, topic, body, qos in rows:
+                info = self.client.publish(topic, body, qos=qos, retain=False)
+                if info.rc != 0:
+                    break
+                sent.append((corr_id, info))
+            # Ta bort ur kön först när brokern har kvitterat (QoS 1), i ett svep
+            delivered = []
+            for corr_id, info in sent:
+                try:
+                    info.wait_for_publish(timeout=10)
+                except (RuntimeError, ValueError):
+                    pass
+                if info.is_published():
+                    delivered.append(corr_id)
+            self.spool.remove(delivered)
+            logging.info(f"Skickade {len(delivered)} av {len(rows)} köade requests")
 
-            response = q.get(timeout=timeout)
+    def _forget(self, corr_id: str, req: "PendingRequest"):
+        with self._pending_lock:
+            # Ett corr_id kan återanvändas av en ny request för samma tur
+            if self.pending.get(corr_id) is req:
+                del self.pending[corr_id]
+
+    def _expire(self, corr_id: str):
+        """Deadline timer callback: fail a request that got no reply in time."""
+        with self._pending_lock:
+            req = self.pending.get(corr_id)
+            if req is None or req.deadline > time.monotonic():
+                # Redan besvarad, eller tidsgränsen har förlängts av ett delsvar
+                return
+            self.pending.pop(corr_id, None)
+        if req.fut.set_running_or_notify_cancel():
+            logging.error(f"Timeout: inget svar från n8n (corr_id={corr_id})")
+            req.fut.set_exception(TimeoutError(f"Inget svar för corr_id={corr_id}"))
+
+    def request_reply(self, text: str, lang: str, qos: int = 1, timeout: int = 15,
+                      cancel_evt: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+        """Send request to n8n workflow and wait for response.
+
+        Blocking wrapper around ``submit``. Returns None on timeout, error or
+        when ``cancel_evt`` is set.
+        """
+        return self.wait_reply(self.submit(text, lang, qos=qos, timeout=timeout), cancel_evt)
+
+    @staticmethod
+    def wait_reply(fut: "RequestFuture", cancel_evt: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+        """Wait for a Future from ``submit``; None on timeout, error or cancel."""
+        try:
+            while not fut.done():
+                if cancel_evt is not None and cancel_evt.is_set():
+                    fut.cancel()
+                    logging.info(f"MQTT-request avbruten (corr_id={fut.corr_id})")
+                    return None
+                futures_wait([fut], timeout=0.1)
+            response = fut.result()
             logging.info("MQTT-svar mottaget från n8n")
             return response
-        except queue.Empty:
-            logging.error("Timeout: inget svar från n8n")
+        except TimeoutError:
+            return None
+        except RequestSpooled:
+            # Redan loggad av _spool_or_fail; requesten skickas när brokern är tillbaka
+            logging.info(f"Inget svar nu, requesten ligger i offlinekön (corr_id={fut.corr_id})")
+            return None
+        except ConnectionError as e:
+            logging.error(f"{e}, kan inte skicka request")
             return None
         except Exception as e:
             logging.error(f"Fel vid MQTT request: {e}")
             return None
-        finally:
-            self.pending.pop(corr_id, None)
+
+class RequestFuture(Future):
+    """Future returned by ``MqttClient.submit``, with its request's state.
+
+    ``text`` is the question; for an audio upload it starts as None and is
+    filled in with the server's transcript when the upload is acked.
+    ``topic`` is the request topic override (None for the configured one).
+    ``acked`` is set on the first message for the request or when the
+    Future completes, and ``chunks`` is the queue of streamed reply text
+    when the caller asked for a streamed reply.
+    """
+
+    def __init__(self, corr_id: str, text: Optional[str], lang: str, topic: Optional[str]):
+        super().__init__()
+        self.corr_id = corr_id
+        self.text = text
+        self.lang = lang
+        self.topic = topic
+        self.t_publish = time.monotonic()
+        self.acked = threading.Event()
+        self.chunks: Optional[queue.Queue] = None
+        self.add_done_callback(lambda f: f.acked.set())
+
+class PendingRequest:
+    """State of one in-flight MQTT request.
+
+    Streamed replies arrive as messages with ``seq`` (0, 1, ...), a partial
+    ``reply`` and ``final: true`` on the last one. Out-of-order chunks are
+    buffered and delivered in sequence. A message without ``seq`` is a
+    complete, non-streamed reply.
+    """
+
+    def __init__(self, fut: RequestFuture, timeout: float, on_chunk=None):
+        self.fut = fut
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+        self.on_chunk = on_chunk
+        self._next_seq = 0
+        self._buffered = {}
+        self._parts = []
+        self._final_seq = None
+        self._last = None
+
+    def accept(self, data: dict) -> bool:
+        """Handle one reply message; return True when the reply is complete."""
+        if "seq" not in data:
+            self._last = data
+            return True
+        try:
+            seq = int(data["seq"])
+        except (TypeError, ValueError):
+            logging.warning(f"Ogiltigt seq i MQTT-delsvar: {data.get('seq')!r}")
+            return False
+        if seq < self._next_seq or seq in self._buffered:
+            logging.debug(f"Dubblett av MQTT-delsvar seq={seq} ignoreras")
+            return False
+        self._buffered[seq] = data
+        if data.get("final"):
+            self._final_seq = seq
+        while self._next_seq in self._buffered:
+            msg = self._buffered.pop(self._next_seq)
+            self._next_seq += 1
+            chunk = msg.get("reply") or ""
+            self._parts.append(chunk)
+            self._last = msg
+            if chunk and self.on_chunk is not None:
+                try:
+                    self.on_chunk(chunk)
+                except Exception as e:
+                    logging.error(f"Fel vid hantering av delsvar: {e}")
+        return self._final_seq is not None and self._next_seq > self._final_seq
+
+    def resolve(self):
+        if not self.fut.set_running_or_notify_cancel():
+            return
+        if self._parts:
+            result = dict(self._last)
+            result["reply"] = "".join(self._parts)
+            result["streamed"] = True
+        else:
+            result = self._last
+        self.fut.set_result(result)
+
+class DeadlineTimer:
+    """One thread that expires many request deadlines.
+
+    Deadlines are kept in a heap, so any number of in-flight requests share a
+    single timer thread instead of one blocking wait each.
+    """
+
+    def __init__(self, on_expire):
+        self._on_expire = on_expire
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="mqtt-deadlines", daemon=True)
+        self._thread.start()
+
+    def add(self, deadline: float, key: str):
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, key))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                deadline, key = self._heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+            try:
+                self._on_expire(key)
+            except Exception as e:
+                logging.error(f"Fel i deadline-timer: {e}")
+
+AUDIO_PAYLOAD_MAGIC = b"GAU1"
+
+def pack_audio_payload(header: Dict[str, Any], audio: bytes) -> bytes:
+    """Binary MQTT payload: magic, 2-byte big-endian header length, JSON header, audio."""
+    head = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return AUDIO_PAYLOAD_MAGIC + struct.pack("!H", len(head)) + head + audio
+
+class AudioUploader:
+    """Sends recordings to a server-side transcriber instead of running STT here.
+
+    Audio is encoded as Opus (in Ogg) or FLAC with ``soundfile``, or sent as
+    raw int16 PCM. When the server does not acknowledge within
+    ``fallback_sec`` the turn falls back to local STT, and uploads are then
+    skipped for ``cooldown_sec`` so a dead server doesn't cost every turn.
+    """
+
+    CODECS = {"opus": ("OGG", "OPUS"), "flac": ("FLAC", "PCM_16"), "pcm": None}
+
+    def __init__(self, remote_cfg: dict, sample_rate: int):
+        self.enabled = bool(remote_cfg.get("enabled", False))
+        self.topic = remote_cfg.get("topic")
+        self.codec = remote_cfg.get("codec", "opus")
+        self.sample_rate = sample_rate
+        self.fallback_sec = float(remote_cfg.get("fallback_sec", 2.0))
+        self.cooldown_sec = float(remote_cfg.get("cooldown_sec", 60))
+        self._skip_until = 0.0
+        self._sf = None
+        if not self.enabled:
+            return
+        if not self.topic:
+            raise ValueError("stt.remote.topic krävs när stt.remote är aktiverat")
+        if self.codec not in self.CODECS:
+            raise ValueError(f"Okänd stt.remote.codec: {self.codec}")
+        # Bara leta upp modulen här; soundfile laddar libsndfile och importeras vid första kodningen
+        if self.CODECS[self.codec] is not None and importlib.util.find_spec("soundfile") is None:
+            raise RuntimeError(f"stt.remote.codec '{self.codec}' kräver paketet soundfile")
+        logging.info(f"Fjärr-STT: skickar ljud ({self.codec}) till {self.topic}")
+
+    def available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._skip_until
+
+    def mark_slow(self):
+        self._skip_until = time.monotonic() + self.cooldown_sec
+
+    def encode(self, pcm: np.ndarray) -> Dict[str, Any]:
+        """Encode int16 PCM into the ``audio`` argument of ``MqttClient.submit``."""
+        if self.CODECS[self.codec] is None:
+            data = pcm.tobytes()
+        else:
+            if self._sf is None:
+                import soundfile
+                self._sf = soundfile
+            fmt, subtype = self.CODECS[self.codec]
+            buf = io.BytesIO()
+            self._sf.write(buf, pcm, self.sample_rate, format=fmt, subtype=subtype)
+            data = buf.getvalue()
+        return {"data": data, "codec": self.codec, "sample_rate": self.sample_rate, "topic": self.topic}
+
+def normalize_text(text: str) -> str:
+    """Normalize a transcript for cache and phrase lookups."""
+    text = re.sub(r"[^\w\s]", " ", text.casefold())
+    return " ".join(text.split())
+
+class CacheEntry:
+    def __init__(self, response: Dict[str, Any], expires: float):
+        self.response = response
+        self.expires = expires
+        self.pcm = None  # syntetiserat tal för svaret, om det har spelats upp en gång
+
+class ResponseCache:
+    """LRU cache of n8n replies keyed on normalized transcript and language
+    (plus the request topic when a wakeword routes to another workflow).
+
+    Entries expire after ``default_ttl_sec`` unless the workflow says
+    otherwise with a ``cache_control`` field in the reply: ``"no-store"``
+    (never cache) or ``"max-age=N"`` (cache for N seconds). Entries can also
+    hold the synthesized PCM of the reply, so repeat answers skip TTS; the
+    total PCM size is capped by ``max_pcm_mb``.
+    """
+
+    def __init__(self, cache_cfg: dict):
+        self.enabled = bool(cache_cfg.get("enabled", True))
+        self.max_entries = int(cache_cfg.get("max_entries", 128))
+        self.default_ttl = float(cache_cfg.get("default_ttl_sec", 0))
+        self.max_pcm_bytes = int(float(cache_cfg.get("max_pcm_mb", 32)) * 1024 * 1024)
+        self._entries = OrderedDict()
+        self._pcm_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(text: str, lang: str, topic: Optional[str] = None) -> Tuple[str, str, Optional[str]]:
+        return normalize_text(text), lang, topic
+
+    def _ttl(self, response: Dict[str, Any]) -> float:
+        directives = str(response.get("cache_control") or "").lower()
+        if "no-store" in directives or "no-cache" in directives:
+            return 0
+        m = re.search(r"max-age\s*=\s*(\d+)", directives)
+        if m:
+            return float(m.group(1))
+        return self.default_ttl
+
+    def get(self, text: str, lang: str, topic: Optional[str] = None) -> Optional[CacheEntry]:
+        if not self.enabled:
+            return None
+        key = self._key(text, lang, topic)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, text: str, lang: str, response: Dict[str, Any],
+            topic: Optional[str] = None) -> Optional[CacheEntry]:
+        """Store a reply if it is cacheable; returns the entry or None."""
+        if not self.enabled or not response:
+            return None
+        ttl = self._ttl(response)
+        if ttl <= 0:
+            return None
+        key = self._key(text, lang, topic)
+        entry = CacheEntry(response, time.monotonic() + ttl)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+        logging.debug(f"Svar cachat i {ttl:.0f} s: '{key[0]}'")
+        return entry
+
+    def set_pcm(self, entry: CacheEntry, pcm: bytes):
+        """Attach synthesized audio to an entry, evicting old audio if needed."""
+        if not pcm or len(pcm) > self.max_pcm_bytes:
+            return
+        with self._lock:
+            if entry not in self._entries.values():
+                return
+            if entry.pcm:
+                self._pcm_bytes -= len(entry.pcm)
+            entry.pcm = pcm
+            self._pcm_bytes += len(pcm)
+            # Släpp ljud från de minst nyligen använda posterna först
+            for other in self._entries.values():
+                if self._pcm_bytes <= self.max_pcm_bytes:
+                    break
+                if other is not entry and other.pcm:
+                    self._pcm_bytes -= len(other.pcm)
+                    other.pcm = None
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.pcm:
+            self._pcm_bytes -= len(entry.pcm)
+
+class LocalIntent:
+    """A locally handled command: an optional shell-free ``command`` to run
+    and an optional ``reply`` template (``{time}`` and ``{date}`` are filled
+    in). With neither, the turn just ends, e.g. for "stopp".
+    """
+
+    def __init__(self, intent_cfg: dict):
+        self.name = intent_cfg["name"]
+        self.reply = intent_cfg.get("reply")
+        self.command = intent_cfg.get("command")
+        if isinstance(self.command, str):
+            self.command = self.command.split()
+        if self.reply:
+            # Fel i mallen ska stoppa starten, inte turen där intenten används
+            try:
+                self.reply.format(time="", date="")
+            except (KeyError, IndexError, ValueError, AttributeError) as e:
+                raise ValueError(f"Ogiltigt svar för intent '{self.name}': {e!r}, "
+                                 f"bara {{time}} och {{date}} fylls i")
+
+    def run(self) -> Optional[str]:
+        """Run the command (if any) and return the reply text (if any)."""
+        if self.command:
+            try:
+                proc = Popen(self.command, stdout=DEVNULL, stderr=PIPE)
+                _, err = proc.communicate(timeout=5)
+                if proc.returncode != 0:
+                    logging.warning(f"Intent '{self.name}': kommandot avslutades med {proc.returncode}: "
+                                    f"{err.decode(errors='replace').strip()}")
+            except TimeoutExpired:
+                proc.kill()
+                logging.warning(f"Intent '{self.name}': kommandot tog för lång tid")
+            except OSError as e:
+                logging.error(f"Intent '{self.name}': kunde inte köra kommandot: {e}")
+        if not self.reply:
+            return None
+        now = datetime.now()
+        return self.reply.format(time=now.strftime("%H.%M"), date=now.strftime("%Y-%m-%d"))
+
+class LocalIntents:
+    """Resolve simple commands in-process, before anything is sent to n8n.
+
+    Each intent lists exact ``phrases`` and/or regex ``patterns``, both
+    matched against the normalized transcript. Phrases go into a dict, so
+    most commands cost one hash probe; patterns are compiled one by one at
+    start and tried in config order.
+    """
+
+    def __init__(self, intents_cfg: dict):
+        self.enabled = bool(intents_cfg.get("enabled", True))
+        self.intents: List[LocalIntent] = []
+        self._phrases: Dict[str, LocalIntent] = {}
+        self._patterns: List[Tuple["re.Pattern", LocalIntent]] = []
+        for intent_cfg in intents_cfg.get("items", []) or []:
+            intent = LocalIntent(intent_cfg)
+            self.intents.append(intent)
+            for phrase in intent_cfg.get("phrases", []) or []:
+                self._phrases.setdefault(normalize_text(phrase), intent)
+            for pattern in intent_cfg.get("patterns", []) or []:
+                # Var för sig: bakåtreferenser, inline-flaggor och namngivna grupper
+                # fungerar då som i ett fristående mönster
+                try:
+                    self._patterns.append((re.compile(pattern), intent))
+                except re.error as e:
+                    raise ValueError(f"Ogiltigt mönster för intent '{intent.name}': {e}")
+        if self.intents:
+            logging.info(f"Lokala intents: {', '.join(i.name for i in self.intents)}")
+
+    def match(self, text: str) -> Optional[LocalIntent]:
+        if not self.enabled or not self.intents:
+            return None
+        norm = normalize_text(text)
+        intent = self._phrases.get(norm)
+        if intent is not None:
+            return intent
+        for pattern, intent in self._patterns:
+            if pattern.fullmatch(norm):
+                return intent
+        return None
+
+class AudioCapture:
+    """Long-lived microphone capture into a preallocated int16 ring buffer.
+
+    A single background thread owns the input stream. Readers (wakeword, VAD,
+    recording) address samples by absolute position, so no audio is lost
+    between pipeline stages.
+    """
+
+    def __init__(self, sample_rate: int, input_device=None, block_len: int = 512, buffer_sec: float = 30.0,
+                 stream_factory=None):
+        self.sample_rate = sample_rate
+        if stream_factory is None:
+            import sounddevice as sd
+            stream_factory = sd.RawInputStream
+        self.stream_factory = stream_factory
+        self.input_device = input_device
+        self.block_len = block_len
+        self.capacity = int(sample_rate * buffer_sec)
+        self._buf = np.zeros(self.capacity, dtype=np.int16)
+        self._write_pos = 0  # totalt antal skrivna samples (monotont växande)
+        self._cond = threading.Condition()
+        self._stop_evt = threading.Event()
+        self._thread = None
+
+    @property
+    def position(self) -> int:
+        """Absolute sample index of the next sample to be written."""
+        with self._cond:
+            return self._write_pos
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_evt.clear()
+        self._thread = threading.Thread(target=self._run, name="audio-capture", daemon=True)
+        self._thread.start()
+        logging.info(f"Ljudinspelning startad ({self.sample_rate} Hz, ringbuffert {self.capacity / self.sample_rate:.0f} s)")
+
+    def stop(self):
+        self._stop_evt.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _write(self, block: np.ndarray):
+        n = len(block)
+        with self._cond:
+            start = self._write_pos % self.capacity
+            first = min(n, self.capacity - start)
+            self._buf[start:start + first] = block[:first]
+            if first < n:
+                self._buf[:n - first] = block[first:]
+            self._write_pos += n
+            self._cond.notify_all()
+
+    def _run(self):
+        while not self._stop_evt.is_set():
+            try:
+                with self.stream_factory(samplerate=self.sample_rate,
+                                       blocksize=self.block_len,
+                                       dtype="int16",
+                                       channels=1,
+                                       device=self.input_device) as stream:
+                    while not self._stop_evt.is_set():
+                        data, overflowed = stream.read(self.block_len)
+                        if overflowed:
+                            logging.debug("Ljudinmatning: overflow")
+                        if data:
+                            self._write(np.frombuffer(data, dtype=np.int16))
+            except Exception as e:
+                logging.error(f"Fel i ljudinmatningen, öppnar om strömmen: {e}")
+                self._stop_evt.wait(1.0)
+
+    def reader(self, pos: Optional[int] = None) -> "CaptureReader":
+        """Create a reader starting at ``pos`` (default: the newest sample)."""
+        return CaptureReader(self, self.position if pos is None else pos)
+
+    def _read(self, pos: int, n: int, timeout: float):
+        out = np.empty(n, dtype=np.int16)
+        pos = self._read_into(pos, out, timeout)
+        return pos, (out if pos is not None else None)
+
+    def _read_into(self, pos: int, out: np.ndarray, timeout: float) -> Optional[int]:
+        """Copy the samples from ``pos`` straight into ``out``; returns the
+        (possibly skipped-ahead) start position, or None on timeout."""
+        n = len(out)
+        if n > self.capacity:
+            raise ValueError(f"Kan inte läsa {n} samples ur en ringbuffert på {self.capacity}")
+        with self._cond:
+            deadline = time.monotonic() + timeout
+            while self._write_pos < pos + n:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop_evt.is_set():
+                    return None
+                self._cond.wait(remaining)
+            oldest = self._write_pos - self.capacity
+            if pos < oldest:
+                logging.warning(f"Ljudläsare för långsam, hoppar över {oldest - pos} samples")
+                pos = oldest
+            start = pos % self.capacity
+            first = min(n, self.capacity - start)
+            out[:first] = self._buf[start:start + first]
+            if first < n:
+                out[first:] = self._buf[:n - first]
+            return pos
+
+class CaptureReader:
+    """Independent read cursor on an AudioCapture ring buffer."""
+
+    def __init__(self, capture: AudioCapture, pos: int):
+        self.capture = capture
+        self.pos = pos
+
+    def read(self, n: int, timeout: float = 2.0) -> Optional[np.ndarray]:
+        """Return the next ``n`` samples, or None on timeout/shutdown.
+
+        A reader that has fallen more than one buffer behind is moved forward
+        to the oldest retained sample.
+        """
+        pos, block = self.capture._read(self.pos, n, timeout)
+        if block is not None:
+            self.pos = pos + n
+        return block
+
+    def read_into(self, out: np.ndarray, timeout: float = 2.0) -> bool:
+        """Fill ``out`` with the next ``len(out)`` samples without an
+        intermediate copy; False on timeout/shutdown."""
+        pos = self.capture._read_into(self.pos, out, timeout)
+        if pos is None:
+            return False
+        self.pos = pos + len(out)
+        return True
+
+class Endpointer:
+    """End-of-speech detection on sample-indexed frames.
+
+    Frame energy (RMS) is computed with NumPy for a whole batch at a time.
+    Frames clearly above the adaptive noise floor count as speech, frames
+    close to it as silence, and only the ambiguous frames in between are
+    passed to webrtcvad. The noise floor follows the non-speech frames, and
+    it is never below the quietest frame of the last ``noise_window_ms``.
+    Steady noise that starts mid-recording (a fan, a TV) therefore stops
+    counting as speech after one window. Between turns ``observe`` keeps the
+    floor current from the capture stream. Within a recording, decisions
+    depend only on the samples, however the audio happens to be batched.
+    """
+
+    def __init__(self, audio_cfg, sample_rate: int, frame_ms: int, vad):
+        ep_cfg = audio_cfg.get("endpoint", {}) or {}
+        self.sample_rate = sample_rate
+        self.frame_size = int(sample_rate * frame_ms / 1000)
+        self.vad = vad
+        self.speech_ratio = 10 ** (float(ep_cfg.get("speech_db", 12)) / 20)
+        self.silence_ratio = 10 ** (float(ep_cfg.get("silence_db", 3)) / 20)
+        self.noise_adapt = float(ep_cfg.get("noise_adapt", 0.05))
+        self.min_floor = float(ep_cfg.get("min_noise_floor", 30))
+        self.noise_floor = float(ep_cfg.get("initial_noise_floor", 200))
+        self.noise_window = max(1, int(int(ep_cfg.get("noise_window_ms", 5000)) / frame_ms))
+        # Glidande minimum av ram-RMS: monoton kö av (ramnummer, rms)
+        self._min_q = deque()
+        self._n = 0
+        # push() körs av turtråden och observe() av wakeword-tråden
+        self._lock = threading.Lock()
+        self.silence_frames = max(1, int(int(audio_cfg.get("silence_end_ms", 800)) / frame_ms))
+        self.vad_calls = 0
+        self.reset()
+
+    def reset(self, arm_after: int = 0):
+        """Start a new utterance; the noise floor is kept.
+
+        Speech in the first ``arm_after`` frames (preroll with the end of the
+        wakeword, the listening earcon) is flagged but does not start the
+        end-of-speech countdown.
+        """
+        self.frames = 0
+        self.arm_after = arm_after
+        self.last_voice = None
+
+    def frame_rms(self, pcm: np.ndarray) -> np.ndarray:
+        frames = pcm[: len(pcm) - len(pcm) % self.frame_size].reshape(-1, self.frame_size).astype(np.float32)
+        return np.sqrt(np.mean(frames * frames, axis=1))
+
+    def _window_min(self, rms: float) -> Optional[float]:
+        """Add a frame to the sliding window; its minimum once the window is full."""
+        self._n += 1
+        q = self._min_q
+        while q and q[-1][1] >= rms:
+            q.pop()
+        q.append((self._n, rms))
+        if q[0][0] <= self._n - self.noise_window:
+            q.popleft()
+        return q[0][1] if self._n >= self.noise_window else None
+
+    def observe(self, pcm: np.ndarray):
+        """Track the noise floor from audio outside a recording (between turns)."""
+        with self._lock:
+            for rms in self.frame_rms(pcm).tolist():
+                low = self._window_min(rms)
+                if low is not None:
+                    self.noise_floor = max(self.min_floor, low)
+
+    def _vad(self, frame: np.ndarray) -> bool:
+        self.vad_calls += 1
+        try:
+            return self.vad.is_speech(frame.tobytes(), self.sample_rate)
+        except Exception as e:
+            logging.debug(f"VAD-fel: {e}")
+            return False
+
+    def push(self, pcm: np.ndarray) -> Tuple[List[bool], Optional[int]]:
+        """Classify the whole frames in ``pcm``.
+
+        Returns the per-frame speech flags and, if the utterance ended inside
+        this batch, the number of frames of the batch that belong to it
+        (``None`` otherwise). Flags after the end are not returned.
+        """
+        with self._lock:
+            return self._push(pcm)
+
+    def _push(self, pcm: np.ndarray) -> Tuple[List[bool], Optional[int]]:
+        flags = []
+        for i, rms in enumerate(self.frame_rms(pcm).tolist()):
+            low = self._window_min(rms)
+            if low is not None and low > self.noise_floor:
+                # Även den tystaste ramen i fönstret ligger över golvet: bakgrunden har blivit starkare
+                self.noise_floor = low
+            if rms >= self.noise_floor * self.speech_ratio:
+                speech = True
+            elif rms <= self.noise_floor * self.silence_ratio:
+                speech = False
+            else:
+                speech = self._vad(pcm[i * self.frame_size:(i + 1) * self.frame_size])
+            if not speech:
+                # Golvet sjunker snabbt och stiger långsamt, så kort brus flyttar det inte
+                rate = self.noise_adapt if rms > self.noise_floor else 0.5
+                self.noise_floor = max(self.min_floor, self.noise_floor + (rms - self.noise_floor) * rate)
+            flags.append(speech)
+            self.frames += 1
+            if speech and self.frames > self.arm_after:
+                self.last_voice = self.frames
+            elif self.last_voice is not None and self.frames - self.last_voice >= self.silence_frames:
+                return flags, i + 1
+        return flags, None
+
+class WakeKeyword:
+    """A Porcupine keyword and what saying it does.
+
+    ``command`` names a local action that is handled at wakeword latency,
+    without recording, STT or MQTT (only ``"stop"``: cancel the current turn).
+    Otherwise a turn is started, with ``language`` and ``request_topic``
+    overriding the defaults when set.
+    """
+
+    COMMANDS = ("stop",)
+
+    def __init__(self, kw_cfg: dict, default_sensitivity: float):
+        self.path = kw_cfg["path"]
+        self.name = kw_cfg.get("name") or Path(self.path).stem
+        self.sensitivity = float(kw_cfg.get("sensitivity", default_sensitivity))
+        self.language = kw_cfg.get("language")
+        self.request_topic = kw_cfg.get("request_topic")
+        self.command = kw_cfg.get("command")
+        if self.command is not None and self.command not in self.COMMANDS:
+            raise ValueError(f"Okänt wakeword-kommando '{self.command}' för {self.name}")
 
 class Recorder:
-    def __init__(self, audio_cfg, wake_cfg):
+    def __init__(self, audio_cfg, wake_cfg, input_stream_factory=None):
+        """``wake_cfg=None`` creates a recorder without wakeword detection
+        (e.g. for benchmarks); ``input_stream_factory`` replaces
+        ``sd.RawInputStream`` for the capture thread.
+        """
         self.audio_cfg = audio_cfg
         self.wake_cfg = wake_cfg
+        self.keywords = self.keywords_from_config(wake_cfg) if wake_cfg is not None else []
+        self.porcupine = self._create_porcupine() if wake_cfg is not None else None
 
-        access_key = os.environ.get(wake_cfg["access_key_env"])
-        if not access_key:
-            raise RuntimeError(f"{wake_cfg['access_key_env']} saknas i miljön")
+        self.sample_rate = int(audio_cfg.get("sample_rate", 16000))
+        self.input_device = audio_cfg.get("input_device", None)
+
+        try:
+            import webrtcvad
+            self.vad = webrtcvad.Vad(int(audio_cfg.get("vad_aggressiveness", 2)))
+        except Exception as e:
+            raise RuntimeError(f"Kunde inte initiera WebRTC VAD: {e}")
+        
+        self.frame_ms = 30
+        self.silence_end_ms = int(audio_cfg.get("silence_end_ms", 800))
+        self.max_utt_sec = int(audio_cfg.get("max_utterance_sec", 12))
+        self.endpointer = Endpointer(audio_cfg, self.sample_rate, self.frame_ms, self.vad)
+        # Inspelningen skrivs direkt hit; återanvänds av varje tur
+        frame_size = int(self.sample_rate * self.frame_ms / 1000)
+        self._utt_buf = np.zeros(int(self.max_utt_sec * 1000 / self.frame_ms) * frame_size, dtype=np.int16)
+        # Ligger läsningen efter (t.ex. medan Whisper kör) tas flera ramar per varv
+        self.max_batch_frames = max(1, int((audio_cfg.get("endpoint", {}) or {}).get("max_batch_frames", 8)))
+
+        self.pv_frame_len = self.porcupine.frame_length if self.porcupine else 512
+        self.pv_sample_rate = self.porcupine.sample_rate if self.porcupine else self.sample_rate
+        if self.pv_sample_rate != self.sample_rate:
+            raise ValueError(f"audio.sample_rate ({self.sample_rate}) måste matcha Porcupine ({self.pv_sample_rate} Hz)")
 
-        keyword_path = wake_cfg["keyword_path"]
-        model_path = wake_cfg.get("model_path", None)
+        # En gemensam, alltid öppen inspelningsström som alla steg läser från
+        self.preroll_ms = int(audio_cfg.get("preroll_ms", 150))
+        self.arm_delay_ms = int((audio_cfg.get("endpoint", {}) or {}).get("arm_delay_ms", 300))
+        self._recording = False
+        self.capture = AudioCapture(
+            self.sample_rate,
+            input_device=self.input_device,
+            block_len=self.pv_frame_len,
+            buffer_sec=float(audio_cfg.get("ring_buffer_sec", 30)),
+            stream_factory=input_stream_factory,
+        )
+
+    @staticmethod
+    def keywords_from_config(wake_cfg: dict) -> List[WakeKeyword]:
+        """Keywords from ``wakeword.keywords``, or the single ``keyword_path``.
+
+        Checks the keyword files too, without creating Porcupine.
+        """
         sensitivity = float(wake_cfg.get("sensitivity", 0.5))
+        entries = wake_cfg.get("keywords") or [{"path": wake_cfg["keyword_path"]}]
+        keywords = [WakeKeyword(kw_cfg, sensitivity) for kw_cfg in entries]
+        for kw in keywords:
+            if not Path(kw.path).exists():
+                raise FileNotFoundError(f"Saknar wakeword-fil: {kw.path}")
+        return keywords
+
+    def _create_porcupine(self):
+        access_key = os.environ.get(self.wake_cfg["access_key_env"])
+        if not access_key:
+            raise RuntimeError(f"{self.wake_cfg['access_key_env']} saknas i miljön")
+
+        model_path = self.wake_cfg.get("model_path", None)
 
-        if not Path(keyword_path).exists():
-            raise FileNotFoundError(f"Saknar wakeword-fil: {keyword_path}")
-        
         # Make model_path optional: skip if None, empty, or file doesn't exist
         # Porcupine will use its built-in default model when model_path is not provided
         use_model_path = False
@@ -288,298 +1282,1952 @@ class Recorder:
         try:
             kwargs = dict(
                 access_key=access_key,
-                keyword_paths=[keyword_path],
-                sensitivities=[sensitivity],
+                keyword_paths=[kw.path for kw in self.keywords],
+                sensitivities=[kw.sensitivity for kw in self.keywords],
             )
             if use_model_path:
                 kwargs["model_path"] = model_path
 
-            self.porcupine = pvporcupine.create(**kwargs)
-            logging.info("Porcupine wakeword-detektor initierad")
+            import pvporcupine
+            porcupine = pvporcupine.create(**kwargs)
+            logging.info(f"Porcupine wakeword-detektor initierad ({', '.join(kw.name for kw in self.keywords)})")
+            return porcupine
         except Exception as e:
             raise RuntimeError(f"Kunde inte initiera Porcupine: {e}")
 
-        self.sample_rate = int(audio_cfg.get("sample_rate", 16000))
-        self.input_device = audio_cfg.get("input_device", None)
-
-        try:
-            self.vad = webrtcvad.Vad(int(audio_cfg.get("vad_aggressiveness", 2)))
-        except Exception as e:
-            raise RuntimeError(f"Kunde inte initiera WebRTC VAD: {e}")
-        
-        self.frame_ms = 30
-        self.silence_end_ms = int(audio_cfg.get("silence_end_ms", 800))
-        self.max_utt_sec = int(audio_cfg.get("max_utterance_sec", 12))
-
-        self.pv_frame_len = self.porcupine.frame_length
-        self.pv_sample_rate = self.porcupine.sample_rate
+    def start(self):
+        """Start the shared capture thread."""
+        self.capture.start()
 
-    def listen_for_wakeword(self, stop_evt: threading.Event):
-        """Listen for wakeword using Porcupine."""
-        logging.info("Lyssnar efter väckningsfras...")
+    def close(self):
+        self.capture.stop()
+        if self.porcupine is None:
+            return
         try:
-            with sd.RawInputStream(samplerate=self.pv_sample_rate,
-                                   blocksize=self.pv_frame_len,
-                                   dtype="int16",
-                                   channels=1,
-                                   device=self.input_device) as stream:
-                while not stop_evt.is_set():
-                    try:
-                        audio = stream.read(self.pv_frame_len)[0]
-                        if not audio:
-                            continue
-                        pcm = np.frombuffer(audio, dtype=np.int16)
-                        result = self.porcupine.process(pcm)
-                        if result >= 0:
-                            logging.info("Väckningsfras detekterad.")
-                            return
-                    except Exception as e:
-                        logging.error(f"Fel vid läsning av ljudström för wakeword: {e}")
-                        time.sleep(0.1)
+            self.porcupine.delete()
         except Exception as e:
-            logging.error(f"Kunde inte öppna ljudinmatning för wakeword: {e}")
-            raise
+            logging.debug(f"Kunde inte frigöra Porcupine: {e}")
 
-    def record_utterance(self) -> bytes:
-        """Record user utterance after wakeword detection."""
-        logging.info("Börjar inspelning...")
-        frame_size = int(self.sample_rate * self.frame_ms / 1000)
-        blocksize = frame_size
+    def wakeword_events(self, stop_evt: threading.Event):
+        """Continuously run Porcupine on the capture buffer.
 
-        def is_speech(frame_bytes):
+        Yields the absolute sample position right after each detected
+        wakeword together with its ``WakeKeyword``. All keywords are checked
+        in the same ``process()`` call. Uses one read cursor for its whole
+        lifetime, so no audio is skipped between detections.
+        """
+        if self.porcupine is None:
+            raise RuntimeError("Wakeword är inte konfigurerat")
+        reader = self.capture.reader()
+        while not stop_evt.is_set():
+            pcm = reader.read(self.pv_frame_len, timeout=0.5)
+            if pcm is None:
+                continue
+            if not self._recording:
+                # Brusgolvet följer bakgrunden även mellan turerna
+                self.endpointer.observe(pcm)
             try:
-                return self.vad.is_speech(frame_bytes, self.sample_rate)
+                result = self.porcupine.process(pcm)
             except Exception as e:
-                logging.debug(f"VAD-fel: {e}")
-                return False
+                logging.error(f"Fel vid wakeword-detektering: {e}")
+                continue
+            if result >= 0:
+                kw = self.keywords[result]
+                logging.info(f"Väckningsfras detekterad ({kw.name}).")
+                yield reader.pos, kw
 
-        try:
-            stream = sd.RawInputStream(samplerate=self.sample_rate,
-                                       blocksize=blocksize,
-                                       dtype="int16",
-                                       channels=1,
-                                       device=self.input_device)
-            stream.start()
-        except Exception as e:
-            logging.error(f"Kunde inte öppna ljudinmatning för inspelning: {e}")
-            raise
+    def record_utterance(self, start_pos: int, on_frame=None,
+                         cancel_evt: Optional[threading.Event] = None,
+                         speech_timeout: Optional[float] = None) -> Tuple[np.ndarray, List[bool], bool]:
+        """Record user utterance from ``start_pos`` minus preroll until end of speech.
+        Returns the PCM (reused by the next call), per-frame VAD flags and whether armed speech was heard."""
+        logging.info("Börjar inspelning...")
+        frame_size = int(self.sample_rate * self.frame_ms / 1000)
+        preroll = int(self.sample_rate * self.preroll_ms / 1000)
+        reader = self.capture.reader(max(0, start_pos - preroll))
 
-        frames = []
-        start_time = time.time()
-        last_voice_time = None
+        # Tidsgränser räknas i samples, inte väggklocka, eftersom vi läser ur bufferten
+        max_frames = int(self.max_utt_sec * 1000 / self.frame_ms)
+        timeout_frames = int(speech_timeout * 1000 / self.frame_ms) if speech_timeout else None
+        ep = self.endpointer
+        # Ramarna före start_pos är slutet av väckningsfrasen, och strax efter hörs
+        # lyssna-tonen; tal räknas först efter dem
+        ep.reset(arm_after=(start_pos - reader.pos + int(self.sample_rate * self.arm_delay_ms / 1000)) // frame_size)
+        buf = self._utt_buf
+        n_samples = 0
+        speech_flags = []
+        self._recording = True
         try:
             while True:
-                try:
-                    block, _ = stream.read(blocksize)
-                    if not block:
-                        continue
-                    frames.append(block)
-                    if is_speech(block):
-                        last_voice_time = time.time()
-
-                    elapsed = time.time() - start_time
-                    if elapsed > self.max_utt_sec:
-                        logging.info("Max längd uppnådd, stoppar inspelning.")
-                        break
-
-                    if last_voice_time is not None:
-                        silence_ms = (time.time() - last_voice_time) * 1000.0
-                        if silence_ms >= self.silence_end_ms:
-                            logging.info("Tystnad detekterad, stoppar inspelning.")
-                            break
-                except Exception as e:
-                    logging.error(f"Fel vid läsning av ljuddata: {e}")
+                if cancel_evt is not None and cancel_evt.is_set():
+                    logging.info("Inspelning avbruten.")
+                    break
+                backlog = (self.capture.position - reader.pos) // frame_size
+                n = max(1, min(backlog, self.max_batch_frames, max_frames - len(speech_flags)))
+                block = buf[n_samples:n_samples + n * frame_size]
+                if not reader.read_into(block):
+                    logging.error("Ingen ljuddata från inspelningsströmmen, stoppar inspelning.")
+                    break
+                flags, end = ep.push(block)
+                if end is not None:
+                    block = block[:end * frame_size]
+                n_samples += len(block)
+                speech_flags.extend(flags)
+                if on_frame:
+                    on_frame(block)
+
+                if end is not None:
+                    logging.info("Tystnad detekterad, stoppar inspelning.")
+                    break
+
+                if len(speech_flags) >= max_frames:
+                    logging.info("Max längd uppnådd, stoppar inspelning.")
+                    break
+
+                if timeout_frames is not None and ep.last_voice is None and len(speech_flags) >= timeout_frames:
+                    logging.info("Inget tal inom tidsgränsen, stoppar inspelning.")
                     break
         finally:
-            stream.stop()
-            stream.close()
+            self._recording = False
 
-        pcm = b"".join(frames)
-        logging.info(f"Inspelning klar: {len(pcm)} bytes, {len(pcm) / (self.sample_rate * 2):.2f} sekunder")
-        return pcm
+        pcm = buf[:n_samples]
+        logging.info(f"Inspelning klar: {pcm.nbytes} bytes, {n_samples / self.sample_rate:.2f} sekunder")
+        return pcm, speech_flags, ep.last_voice is not None
 
-class LocalSTT:
-    def __init__(self, stt_cfg, sample_rate: int):
-        model_dir = stt_cfg["model_dir"]
-        compute_type = stt_cfg.get("compute_type", "int8")
-        self.language = stt_cfg.get("language", "sv")
-        self.beam_size = int(stt_cfg.get("beam_size", 5))
-        self.sample_rate = sample_rate
+class WhisperBackend:
+    """faster-whisper (CTranslate2) model on the CPU."""
 
+    def __init__(self, model_dir: str, compute_type: str = "int8", cpu_threads: int = 0, num_workers: int = 1):
         if not Path(model_dir).exists():
             raise FileNotFoundError(f"Whisper-modell saknas: {model_dir}")
 
         logging.info(f"Laddar Faster-Whisper från: {model_dir} (compute_type={compute_type})")
         try:
-            self.model = WhisperModel(model_dir, device="cpu", compute_type=compute_type)
+            from faster_whisper import WhisperModel
+            self.model = WhisperModel(model_dir, device="cpu", compute_type=compute_type,
+                                      cpu_threads=cpu_threads, num_workers=num_workers)
             logging.info("Faster-Whisper modell laddad")
         except Exception as e:
             raise RuntimeError(f"Kunde inte ladda Whisper-modell: {e}")
 
-    def transcribe_pcm(self, pcm_bytes: bytes) -> str:
-        """Transcribe PCM audio data to text."""
-        try:
-            # Konvertera PCM int16 -> float32 [-1, 1] @ 16 kHz
-            pcm = np.frombuffer(pcm_bytes, dtype=np.int16).astype(np.float32) / 32768.0
-            segments, info = self.model.transcribe(
-                pcm,
-                beam_size=self.beam_size,
-                language=self.language,
-                vad_filter=True,
-                vad_parameters={"min_silence_duration_ms": 300},
-            )
-            text = "".join([seg.text for seg in segments]).strip()
-            logging.info(f"STT: '{text}' (språk: {info.language}, sannolikhet: {info.language_probability:.2f})")
-            return text
-        except Exception as e:
-            logging.error(f"Fel vid transkribering: {e}")
-            return ""
+    def transcribe(self, audio: np.ndarray, **kwargs):
+        """Decode float32 audio; returns (list of segments, info)."""
+        segments, info = self.model.transcribe(audio, **kwargs)
+        # Segmenten avkodas lat, så de läses ut här medan ljudbufferten är giltig
+        return list(segments), info
 
-class PiperTTS:
-    def __init__(self, tts_cfg):
-        self.piper_bin = tts_cfg["piper_bin"]
-        self.model_path = tts_cfg["model_path"]
-        self.keep_wav = bool(tts_cfg.get("keep_wav", False))
+    def encode(self, text: str) -> Optional[List[int]]:
+        """Token ids for ``text`` the way faster-whisper encodes an initial prompt."""
+        tokenizer = getattr(self.model, "hf_tokenizer", None)
+        if tokenizer is None:
+            return None
+        return tokenizer.encode(" " + text.strip(), add_special_tokens=False).ids
 
-        if not Path(self.piper_bin).exists():
-            raise FileNotFoundError(f"Hittar inte piper-binär: {self.piper_bin}")
-        if not Path(self.model_path).exists():
-            raise FileNotFoundError(f"Hittar inte piper-modellen: {self.model_path}")
-        
-        logging.info("Piper TTS initierad")
+# stt.backend -> klass; en backend tar (model_dir, compute_type, cpu_threads, num_workers),
+# har transcribe(audio, **kwargs) som faster-whisper och encode(text) -> token-id:n eller None
+STT_BACKENDS = {"faster_whisper": WhisperBackend}
 
-    def speak(self, text: str):
-        """Convert text to speech and play it."""
-        if not text:
-            logging.warning("Tom text skickad till TTS, hoppar över")
-            return
-        
-        # Sanitize text to prevent command injection
-        text = text.strip()
-        if not text:
+class LocalSTT:
+    """Whisper transcription, optionally tiered.
+
+    With a ``fast`` tier configured, every clip is first decoded with the fast
+    settings (a smaller model and/or greedy decoding). Only when the result
+    looks unreliable -- average log-probability below ``min_avg_logprob`` or
+    no-speech probability above ``max_no_speech_prob`` -- is it decoded again
+    with the main model and ``beam_size``.
+
+    Every decode is primed with an initial prompt made of the domain
+    ``initial_prompt``/``vocabulary`` (tokenized once per backend and cached
+    until replaced with ``set_vocabulary``) and, within
+    ``context_window_sec``, the previous turn's transcript.
+    """
+
+    # Whisper använder högst max_length // 2 - 1 = 223 token av prompten (de sista)
+    PROMPT_MAX_TOKENS = 223
+
+    @staticmethod
+    def check_config(stt_cfg: dict) -> type:
+        """Validate ``stt`` without loading a model; returns the backend class."""
+        vad_mode = stt_cfg.get("vad_mode", "whisper")
+        if vad_mode not in ("whisper", "recorder"):
+            raise ValueError(f"Okänt stt.vad_mode: {vad_mode}")
+        backend_name = stt_cfg.get("backend", "faster_whisper")
+        if backend_name not in STT_BACKENDS:
+            raise ValueError(f"Okänd stt.backend: {backend_name}")
+        model_dirs = [stt_cfg["model_dir"]]
+        if stt_cfg.get("fast"):
+            model_dirs.append(stt_cfg["fast"].get("model_dir", stt_cfg["model_dir"]))
+        for model_dir in model_dirs:
+            if not Path(model_dir).exists():
+                raise FileNotFoundError(f"Whisper-modell saknas: {model_dir}")
+        return STT_BACKENDS[backend_name]
+
+    def __init__(self, stt_cfg, sample_rate: int):
+        backend_cls = self.check_config(stt_cfg)
+        model_dir = stt_cfg["model_dir"]
+        self.language = stt_cfg.get("language", "sv")
+        self.beam_size = int(stt_cfg.get("beam_size", 5))
+        self.sample_rate = sample_rate
+        self.incremental = bool(stt_cfg.get("incremental", False))
+        self.incremental_interval = int(stt_cfg.get("incremental_interval_ms", 1000)) / 1000.0
+        # "whisper": Silero VAD i faster-whisper, "recorder": återanvänd inspelningens WebRTC-beslut
+        self.vad_mode = stt_cfg.get("vad_mode", "whisper")
+        if self.incremental and self.vad_mode == "recorder":
+            # Fönstren avkodas medan inspelningen pågår; grindning skulle flytta
+            # segmentens tidsstämplar som commit-logiken bygger på
+            logging.warning("stt.vad_mode: recorder gäller inte inkrementell STT; fönstren avkodas med "
+                            "Whisper-VAD och inspelningens VAD används bara för att hoppa över tysta yttranden")
+        self.vad_pad_ms = int(stt_cfg.get("vad_pad_ms", 150))
+        self.vad_max_pause_ms = int(stt_cfg.get("vad_max_pause_ms", 300))
+
+        compute_type = stt_cfg.get("compute_type", "int8")
+        cpu_threads = int(stt_cfg.get("cpu_threads", 0))
+        num_workers = int(stt_cfg.get("num_workers", 1))
+        self.backend = backend_cls(model_dir, compute_type, cpu_threads, num_workers)
+
+        fast_cfg = stt_cfg.get("fast") or None
+        self.fast_backend = None
+        self.fast_beam_size = 1
+        self.fallbacks = 0
+        if fast_cfg:
+            fast_dir = fast_cfg.get("model_dir", model_dir)
+            if fast_dir == model_dir:
+                self.fast_backend = self.backend
+            else:
+                self.fast_backend = backend_cls(fast_dir, fast_cfg.get("compute_type", compute_type),
+                                                cpu_threads, num_workers)
+            self.fast_beam_size = int(fast_cfg.get("beam_size", 1))
+            fallback_cfg = stt_cfg.get("fallback", {}) or {}
+            self.min_avg_logprob = float(fallback_cfg.get("min_avg_logprob", -0.7))
+            self.max_no_speech_prob = float(fallback_cfg.get("max_no_speech_prob", 0.6))
+
+        self.context_window = float(stt_cfg.get("context_window_sec", 0))
+        self._context = None  # (transkript, monotonic-tid) från föregående tur
+        self._prompt_lock = threading.Lock()
+        self.initial_prompt = None
+        self.vocabulary = []
+        self.set_vocabulary(stt_cfg.get("initial_prompt"), stt_cfg.get("vocabulary"))
+
+        # Float32-buffert som återanvänds mellan avkodningar; växer vid behov
+        self._scratch = np.zeros(0, dtype=np.float32)
+        self._scratch_lock = threading.Lock()
+
+    def set_vocabulary(self, initial_prompt: Optional[str], vocabulary: Optional[List[str]]):
+        """Replace the domain prompt and tokenize it for every backend."""
+        initial_prompt = (initial_prompt or "").strip() or None
+        vocabulary = [w.strip() for w in vocabulary or [] if w and w.strip()]
+        words = ", ".join(vocabulary) + "." if vocabulary else None
+        text = " ".join(p for p in (initial_prompt, words) if p) or None
+        tokens = {}
+        if text:
+            for backend in (self.backend, self.fast_backend):
+                if backend is not None and id(backend) not in tokens:
+                    tokens[id(backend)] = backend.encode(text)
+        with self._prompt_lock:
+            self.initial_prompt = initial_prompt
+            self.vocabulary = vocabulary
+            self._domain_prompt = text
+            self._domain_tokens = tokens
+        if text:
+            n_tokens = len(tokens.get(id(self.backend)) or [])
+            logging.info(f"STT-ordförråd: {len(vocabulary)} ord/fraser, {n_tokens} token")
+            if n_tokens > self.PROMPT_MAX_TOKENS:
+                logging.warning(f"STT-ordförrådet är {n_tokens} token men Whisper använder bara de sista "
+                                f"{self.PROMPT_MAX_TOKENS}; början av prompten ignoreras")
+
+    def remember(self, text: str):
+        """Keep a finished transcript as context for a follow-up question."""
+        if self.context_window > 0 and text:
+            self._context = (text, time.monotonic())
+
+    def _prompt(self, backend, extra: Optional[str]) -> Optional[Union[str, List[int]]]:
+        """Initial prompt for ``backend``: domain tokens, then context and ``extra``."""
+        texts = []
+        if self._context and time.monotonic() - self._context[1] <= self.context_window:
+            texts.append(self._context[0])
+        if extra:
+            texts.append(extra)
+        with self._prompt_lock:
+            domain, tokens = self._domain_prompt, self._domain_tokens.get(id(backend))
+        if domain is None:
+            return " ".join(texts) or None
+        if tokens is None:
+            # Backend utan tokenizer: skicka prompten som text
+            return " ".join([domain] + texts)
+        # Whisper behåller slutet av en för lång prompt; korta därför sammanhanget
+        # (från början) så att domänorden alltid får plats
+        room = self.PROMPT_MAX_TOKENS - len(tokens)
+        tail = backend.encode(" ".join(texts)) if texts and room > 0 else None
+        return tokens + (tail[-room:] if tail else [])
+
+    def _decode(self, pcm, initial_prompt: Optional[str] = None, vad_filter: bool = True,
+                language: Optional[str] = None, word_timestamps: bool = False, scratch: bool = True):
+        """Run Whisper on int16 PCM (bytes or array) and return (segments, info).
+
+        ``scratch=False`` converts into a buffer of its own instead of the
+        shared scratch buffer, so the decode does not wait for another one
+        (given enough ``num_workers``).
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        kwargs = {}
+        if vad_filter:
+            kwargs["vad_parameters"] = {"min_silence_duration_ms": 300}
+        if word_timestamps:
+            kwargs["word_timestamps"] = True
+        kwargs.update(language=language or self.language, vad_filter=vad_filter)
+        if not scratch:
+            return self._decode_audio(samples.astype(np.float32) / np.float32(32768.0), initial_prompt, kwargs)
+        with self._scratch_lock:
+            if self._scratch.size < samples.size:
+                self._scratch = np.empty(samples.size, dtype=np.float32)
+            # PCM int16 -> float32 [-1, 1] i ett steg, utan mellanliggande kopior
+            audio = self._scratch[:samples.size]
+            np.multiply(samples, np.float32(1 / 32768.0), out=audio)
+            return self._decode_audio(audio, initial_prompt, kwargs)
+
+    def _decode_audio(self, audio: np.ndarray, initial_prompt: Optional[str], kwargs: Dict[str, Any]):
+        if self.fast_backend is not None:
+            segments, info = self.fast_backend.transcribe(
+                audio, beam_size=self.fast_beam_size,
+                initial_prompt=self._prompt(self.fast_backend, initial_prompt), **kwargs)
+            if self._confident(segments):
+                return segments, info
+            self.fallbacks += 1
+        return self.backend.transcribe(audio, beam_size=self.beam_size,
+                                       initial_prompt=self._prompt(self.backend, initial_prompt), **kwargs)
+
+    def _confident(self, segments) -> bool:
+        """Whether a fast-tier result is good enough to skip the main model."""
+        if not segments:
+            return True
+        weights = np.array([max(seg.end - seg.start, 0.01) for seg in segments])
+        avg_logprob = float(np.average([seg.avg_logprob for seg in segments], weights=weights))
+        no_speech = max(seg.no_speech_prob for seg in segments)
+        if avg_logprob >= self.min_avg_logprob and no_speech <= self.max_no_speech_prob:
+            return True
+        logging.info(f"STT: osäker snabbavkodning (avg_logprob={avg_logprob:.2f}, "
+                     f"no_speech={no_speech:.2f}), avkodar om med huvudmodellen")
+        return False
+
+    def _gate_speech(self, pcm, speech_flags: List[bool], frame_ms: int) -> np.ndarray:
+        """Keep only speech frames (plus padding) according to the recorder's VAD.
+
+        Leading and trailing silence is trimmed to ``vad_pad_ms`` and internal
+        pauses longer than ``vad_max_pause_ms`` are collapsed to that length.
+        """
+        frame_len = int(self.sample_rate * frame_ms / 1000)
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        n_frames = min(len(speech_flags), samples.size // frame_len)
+        speech = np.asarray(speech_flags[:n_frames], dtype=bool)
+        idx = np.flatnonzero(speech)
+        if idx.size == 0:
+            return np.zeros(0, dtype=np.int16)
+
+        pad = self.vad_pad_ms // frame_ms
+        max_pause = max(1, self.vad_max_pause_ms // frame_ms)
+        keep = np.zeros(n_frames, dtype=bool)
+        keep[max(0, idx[0] - pad):idx[-1] + pad + 1] = True
+
+        # Korta ner långa pauser: behåll halva max_pause på var sida om pausen
+        gaps = np.flatnonzero(np.diff(idx) - 1 > max_pause)
+        head = max_pause // 2
+        for g in gaps:
+            keep[idx[g] + 1 + head:idx[g + 1] - (max_pause - head)] = False
+
+        frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+        return frames[keep].ravel()
+
+    def transcribe_pcm(self, pcm, speech_flags: Optional[List[bool]] = None, frame_ms: int = 30,
+                       language: Optional[str] = None) -> str:
+        """Transcribe int16 PCM (bytes or array) to text.
+
+        With ``vad_mode: recorder`` and ``speech_flags`` from the recorder, the
+        audio is gated with those decisions and Whisper's own VAD is skipped.
+        """
+        try:
+            if self.vad_mode == "recorder" and speech_flags is not None:
+                gated = self._gate_speech(pcm, speech_flags, frame_ms)
+                if gated.size == 0:
+                    logging.info("STT: inget tal enligt VAD, hoppar över avkodning")
+                    return ""
+                logging.debug(f"STT: VAD-grindat ljud {gated.size / self.sample_rate:.2f} s "
+                              f"av {np.frombuffer(pcm, dtype=np.int16).size / self.sample_rate:.2f} s")
+                segments, info = self._decode(gated, vad_filter=False, language=language)
+            else:
+                segments, info = self._decode(pcm, language=language)
+            text = "".join([seg.text for seg in segments]).strip()
+            logging.info(f"STT: '{text}' (språk: {info.language}, sannolikhet: {info.language_probability:.2f})")
+            return text
+        except Exception as e:
+            logging.error(f"Fel vid transkribering: {e}")
+            return ""
+
+    def warmup(self) -> float:
+        """Run a short synthetic clip through the model; returns seconds taken.
+
+        The first decode after loading allocates CTranslate2 buffers and
+        decoder state; doing it here keeps that cost out of the first turn.
+        """
+        t0 = time.monotonic()
+        rng = np.random.default_rng(0)
+        clip = (rng.standard_normal(self.sample_rate) * 100).astype(np.float32) / 32768.0
+        try:
+            for backend, beam_size in ((self.fast_backend, self.fast_beam_size),
+                                       (self.backend, self.beam_size)):
+                if backend is not None:
+                    backend.transcribe(clip, beam_size=beam_size, language=self.language, vad_filter=False)
+        except Exception as e:
+            logging.warning(f"Uppvärmning av Whisper misslyckades: {e}")
+        elapsed = time.monotonic() - t0
+        logging.info(f"Whisper uppvärmd på {elapsed * 1000:.0f} ms")
+        return elapsed
+
+    def start_incremental(self, language: Optional[str] = None) -> "IncrementalTranscriber":
+        """Start transcribing an utterance in the background while it is recorded."""
+        inc = IncrementalTranscriber(self, self.incremental_interval, language)
+        inc.start()
+        return inc
+
+class IncrementalTranscriber:
+    """Windowed Whisper transcription of a growing recording.
+
+    A background thread re-decodes the not yet committed tail of the audio
+    every ``interval`` seconds with word timestamps. The leading words that
+    two consecutive decodes agree on are committed (their text kept and the
+    window moved past them), except the last word and words ending within
+    ``COMMIT_MARGIN`` seconds of the window end, which may still change as
+    the audio grows. At end of speech only the short uncommitted tail has to
+    be decoded; a background decode still running then is not waited for and
+    its result is dropped.
+    """
+
+    COMMIT_MARGIN = 0.5
+
+    def __init__(self, stt: LocalSTT, interval: float = 1.0, language: Optional[str] = None):
+        self.stt = stt
+        self.interval = interval
+        self.language = language
+        self._pcm = bytearray()
+        self._lock = threading.Lock()
+        self._stop_evt = threading.Event()
+        self._thread = None
+        self._committed_bytes = 0
+        self._committed_text = []
+        self._prev_hypothesis = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stt-incremental", daemon=True)
+        self._thread.start()
+
+    def feed(self, frame_bytes: bytes):
+        """Append newly recorded PCM (called from the recording loop)."""
+        with self._lock:
+            self._pcm.extend(frame_bytes)
+
+    def _run(self):
+        min_bytes = int(self.stt.sample_rate * 2 * self.interval)
+        while not self._stop_evt.wait(self.interval):
+            with self._lock:
+                window = bytes(self._pcm[self._committed_bytes:])
+            if len(window) < min_bytes:
+                continue
+            try:
+                self._step(window)
+            except Exception as e:
+                logging.debug(f"Inkrementell STT misslyckades: {e}")
+
+    def _step(self, window: bytes):
+        segments, _ = self.stt._decode(window, initial_prompt=self._prompt(), language=self.language,
+                                       word_timestamps=True, scratch=False)
+        words = [w for seg in segments for w in (getattr(seg, "words", None) or [])]
+        hypothesis = [normalize_text(w.word) for w in words]
+        prev, self._prev_hypothesis = self._prev_hypothesis, hypothesis
+        if not prev:
             return
-            
-        wav_path = f"/tmp/genio_tts_{uuid.uuid4().hex}.wav"
+
+        # Gemensamt ordprefix med förra passet, utom sista ordet och ord nära fönstrets slut
+        n_stable = 0
+        for cur, old in zip(hypothesis[:-1], prev):
+            if cur != old:
+                break
+            n_stable += 1
+        window_end = len(window) / (2 * self.stt.sample_rate)
+        while n_stable > 0 and words[n_stable - 1].end > window_end - self.COMMIT_MARGIN:
+            n_stable -= 1
+        if n_stable == 0:
+            return
+
+        # Klipp mitt i pausen till nästa ord, så att dess början inte hamnar i det committade
+        cut = (words[n_stable - 1].end + words[n_stable].start) / 2
+        with self._lock:
+            if self._stop_evt.is_set():
+                return  # finish() har redan tagit över
+            self._committed_text.extend(w.word.strip() for w in words[:n_stable])
+            self._committed_bytes += min(int(cut * self.stt.sample_rate) * 2, len(window)) & ~1
+        self._prev_hypothesis = None
+        logging.debug(f"Inkrementell STT: committade {n_stable} ord")
+
+    def _prompt(self) -> Optional[str]:
+        with self._lock:
+            return " ".join(self._committed_text) or None
+
+    def cancel(self):
+        self._stop_evt.set()
+
+    def finish(self, speech_flags: Optional[List[bool]] = None) -> str:
+        """Stop the background thread and decode the remaining tail.
+
+        With ``vad_mode: recorder`` an utterance the recorder's VAD found no
+        speech in is not decoded at all.
+        """
+        # Ett pågående bakgrundspass väntas inte in; det ser stop-flaggan och kastar sitt resultat
+        with self._lock:
+            self._stop_evt.set()
+            tail = bytes(self._pcm[self._committed_bytes:])
+            committed = list(self._committed_text)
+        if self.stt.vad_mode == "recorder" and speech_flags is not None and not any(speech_flags):
+            logging.info("STT: inget tal enligt VAD, hoppar över avkodning")
+            return ""
         try:
-            logging.info(f"TTS: Genererar tal för '{text[:50]}...'")
-            p = Popen([self.piper_bin, "-m", self.model_path, "-f", wav_path], stdin=PIPE)
-            p.communicate(input=text.encode("utf-8"), timeout=30)
-            
-            if p.returncode != 0:
-                logging.error(f"Piper avslutades med felkod {p.returncode}")
-                return
-            
-            if not Path(wav_path).exists():
-                logging.error("Piper genererade ingen WAV-fil")
-                return
-                
-            logging.info("Spelar upp tal...")
-            result = run(["aplay", "-q", wav_path], capture_output=True, timeout=30)
-            if result.returncode != 0:
-                logging.error(f"aplay fel: {result.stderr.decode('utf-8', errors='ignore')}")
-        except CalledProcessError as e:
-            logging.error(f"Fel vid uppspelning med aplay: {e}")
-        except TimeoutError:
-            logging.error("TTS timeout")
+            segments, info = (self.stt._decode(tail, initial_prompt=" ".join(committed) or None,
+                                               language=self.language) if tail else ([], None))
+        except Exception as e:
+            logging.error(f"Fel vid transkribering: {e}")
+            segments = []
+        text = " ".join(committed + [seg.text.strip() for seg in segments]).strip()
+        logging.info(f"STT (inkrementell): '{text}' ({len(committed)} ord klara före talslut, "
+                     f"{len(tail) / (self.stt.sample_rate * 2):.2f} s kvar att avkoda)")
+        return text
+
+class PiperTTS:
+    """Piper TTS backed by one resident piper process.
+
+    The voice model is loaded once when the process starts. Each utterance is
+    sent as one line on stdin and piper streams raw 16-bit PCM back on stdout,
+    which is written to a sounddevice output stream as it arrives. The process
+    is restarted automatically if it dies.
+    """
+
+    # Piper loggar denna rad på stderr när ett yttrande är helt syntetiserat
+    DONE_MARKER = b"Real-time factor"
+    # Läggs i ljudkön i stället för None när syntesen misslyckades
+    FAILED = object()
+
+    @staticmethod
+    def check_config(tts_cfg: dict):
+        """Check that the piper binary and voice exist, without starting piper."""
+        if not Path(tts_cfg["piper_bin"]).exists():
+            raise FileNotFoundError(f"Hittar inte piper-binär: {tts_cfg['piper_bin']}")
+        if not Path(tts_cfg["model_path"]).exists():
+            raise FileNotFoundError(f"Hittar inte piper-modellen: {tts_cfg['model_path']}")
+
+    def __init__(self, tts_cfg, output_stream_factory=None):
+        self.check_config(tts_cfg)
+        self.piper_bin = tts_cfg["piper_bin"]
+        if output_stream_factory is None:
+            import sounddevice as sd
+            output_stream_factory = sd.RawOutputStream
+        self.output_stream_factory = output_stream_factory
+        self.model_path = tts_cfg["model_path"]
+        self.keep_wav = bool(tts_cfg.get("keep_wav", False))
+        self.out_dir = Path(tts_cfg.get("wav_dir", "/tmp/genio_tts"))
+        self.synth_timeout = float(tts_cfg.get("synth_timeout_sec", 30))
+        self.output_device = tts_cfg.get("output_device", None)
+        self.prefetch_chunks = int(tts_cfg.get("prefetch_chunks", 64))
+
+        self.sample_rate = int(tts_cfg.get("sample_rate") or self._voice_sample_rate())
+
+        self._proc = None
+        self._stderr_tail = b""
+        self._lock = threading.Lock()
+        self._engine_lock = threading.Lock()
+        self._start_engine()
+        logging.info(f"Piper TTS initierad ({self.sample_rate} Hz)")
+
+    def _voice_sample_rate(self) -> int:
+        """Read the voice sample rate from the model's .onnx.json sidecar."""
+        cfg_path = Path(f"{self.model_path}.json")
+        try:
+            with open(cfg_path, "r", encoding="utf-8") as f:
+                return int(json.load(f)["audio"]["sample_rate"])
+        except Exception as e:
+            logging.warning(f"Kunde inte läsa samplingsfrekvens från {cfg_path} ({e}), antar 22050 Hz")
+            return 22050
+
+    def _start_engine(self):
+        self._proc = Popen(
+            [self.piper_bin, "-m", self.model_path, "--output-raw"],
+            stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=0,
+        )
+        self._stderr_tail = b""
+        logging.info(f"Piper-process startad (pid={self._proc.pid})")
+
+    def _stop_engine(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+            proc.wait(timeout=2)
+        except Exception:
+            proc.kill()
+
+    def _ensure_engine(self):
+        if self._proc is None or self._proc.poll() is not None:
+            if self._proc is not None:
+                logging.warning(f"Piper-processen avslutades (kod {self._proc.returncode}), startar om")
+            self._start_engine()
+
+    def _read_audio(self, proc):
+        """Yield raw PCM from piper until it reports the utterance as done.
+
+        Returns False if the process died before finishing and raises
+        RuntimeError if piper stops producing output.
+        """
+        out_fd = proc.stdout.fileno()
+        err_fd = proc.stderr.fileno()
+        sel = selectors.DefaultSelector()
+        sel.register(out_fd, selectors.EVENT_READ)
+        sel.register(err_fd, selectors.EVENT_READ)
+        try:
+            while True:
+                events = sel.select(timeout=self.synth_timeout)
+                if not events:
+                    logging.error("TTS timeout, startar om Piper")
+                    proc.kill()
+                    proc.wait()
+                    raise RuntimeError("Piper svarade inte inom tidsgränsen")
+                for key, _ in events:
+                    if key.fd == out_fd:
+                        data = os.read(out_fd, 8192)
+                        if not data:
+                            return False
+                        yield data
+                        continue
+
+                    data = os.read(err_fd, 4096)
+                    if not data:
+                        return False
+                    *lines, self._stderr_tail = (self._stderr_tail + data).split(b"\n")
+                    for line in lines:
+                        logging.debug(f"piper: {line.decode('utf-8', errors='ignore').strip()}")
+                    if any(self.DONE_MARKER in line for line in lines):
+                        # Piper skriver allt ljud innan loggraden; töm det som finns kvar i röret
+                        os.set_blocking(out_fd, False)
+                        try:
+                            while True:
+                                data = os.read(out_fd, 8192)
+                                if not data:
+                                    break
+                                yield data
+                        except BlockingIOError:
+                            pass
+                        finally:
+                            os.set_blocking(out_fd, True)
+                        return True
+        finally:
+            sel.close()
+
+    def _stream(self, text: str):
+        """Yield raw PCM chunks for ``text`` from the resident piper process."""
+        for attempt in range(2):
+            self._ensure_engine()
+            proc = self._proc
+            try:
+                proc.stdin.write(text.encode("utf-8") + b"\n")
+                proc.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                logging.warning(f"Kunde inte skriva till Piper: {e}")
+                self._stop_engine()
+                continue
+
+            produced = False
+            reader = self._read_audio(proc)
+            try:
+                while True:
+                    chunk = next(reader)
+                    produced = True
+                    yield chunk
+            except StopIteration as done:
+                if done.value:
+                    return
+            # Processen dog mitt i: starta om, men upprepa inte ljud som redan spelats
+            logging.warning("Piper-processen avslutades oväntat, startar om")
+            self._stop_engine()
+            if produced:
+                raise RuntimeError("Piper avslutades mitt i ett yttrande")
+        raise RuntimeError("Piper kunde inte generera tal")
+
+    def close(self):
+        with self._engine_lock:
+            self._stop_engine()
+
+    def _produce(self, sentences, chunks: queue.Queue, abort: threading.Event):
+        """Synthesize sentences in order and feed PCM chunks to the player.
+
+        Ends with None when every sentence was synthesized, or ``FAILED``.
+        """
+        end = None
+        try:
+            for sentence in sentences:
+                if abort.is_set():
+                    break
+                with self._engine_lock:
+                    carry = b""
+                    for chunk in self._stream(sentence):
+                        if abort.is_set():
+                            # Töm resten av meningen så att nästa yttrande inte får gammalt ljud
+                            continue
+                        # Håll ihop 16-bitars samples om en läsning delar ett sample
+                        chunk = carry + chunk
+                        cut = len(chunk) & ~1
+                        chunk, carry = chunk[:cut], chunk[cut:]
+                        if chunk:
+                            self._put(chunks, chunk, abort)
         except Exception as e:
-            logging.error(f"Oväntat TTS-fel: {e}")
+            logging.error(f"Fel vid talsyntes: {e}")
+            end = self.FAILED
         finally:
-            if not self.keep_wav:
-                try:
-                    Path(wav_path).unlink(missing_ok=True)
-                except Exception as e:
-                    logging.debug(f"Kunde inte ta bort temporär WAV-fil: {e}")
+            self._put(chunks, end, abort)
+
+    @staticmethod
+    def _put(chunks: queue.Queue, item, abort: threading.Event) -> bool:
+        """Put into the bounded queue, giving up if playback was aborted."""
+        while not abort.is_set():
+            try:
+                chunks.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def speak(self, text: str, cancel_evt: Optional[threading.Event] = None,
+              tee: Optional[bytearray] = None, on_first_audio=None) -> bool:
+        """Convert text to speech and stream it to the output device.
+
+        The text is split into sentences; a producer thread synthesizes
+        sentence N+1 while sentence N is playing, so time-to-first-audio only
+        depends on the first sentence. Setting ``cancel_evt`` stops playback
+        immediately (barge-in). The played PCM is appended to ``tee`` if
+        given and ``on_first_audio`` is called when the first audio is
+        written. Returns True if the whole text was synthesized and played.
+        """
+        if not text:
+            logging.warning("Tom text skickad till TTS, hoppar över")
+            return False
+
+        sentences = split_sentences(text)
+        if not sentences:
+            return False
+
+        logging.info(f"TTS: Genererar tal för '{text[:50]}...' ({len(sentences)} meningar)")
+        return self._play_sentences(sentences, cancel_evt, tee, on_first_audio)
+
+    def speak_stream(self, text_chunks, cancel_evt: Optional[threading.Event] = None,
+                     tee: Optional[bytearray] = None, on_first_audio=None) -> bool:
+        """Speak text that arrives in chunks, e.g. a streamed n8n reply.
+
+        Each sentence is synthesized as soon as it is complete, so playback
+        starts before the whole reply has arrived.
+        """
+        logging.info("TTS: Strömmat svar")
+        return self._play_sentences(iter_sentences(text_chunks), cancel_evt, tee, on_first_audio)
+
+    def warmup(self, text: str = "Hej.") -> float:
+        """Synthesize a short phrase and discard it; returns seconds taken."""
+        t0 = time.monotonic()
+        try:
+            self.synthesize(text)
+        except Exception as e:
+            logging.warning(f"Uppvärmning av Piper misslyckades: {e}")
+        elapsed = time.monotonic() - t0
+        logging.info(f"Piper uppvärmd på {elapsed * 1000:.0f} ms")
+        return elapsed
+
+    def synthesize(self, text: str) -> bytes:
+        """Synthesize text to raw PCM without playing it."""
+        pcm = bytearray()
+        for sentence in split_sentences(text):
+            with self._engine_lock:
+                for chunk in self._stream(sentence):
+                    pcm.extend(chunk)
+        return bytes(pcm[:len(pcm) & ~1])
+
+    def play_pcm(self, pcm: bytes, cancel_evt: Optional[threading.Event] = None, on_first_audio=None) -> bool:
+        """Play already synthesized PCM (e.g. from the response cache)."""
+        with self._lock:
+            try:
+                logging.info(f"Spelar upp cachat tal ({len(pcm) / (self.sample_rate * 2):.2f} s)")
+                with self.output_stream_factory(samplerate=self.sample_rate, channels=1, dtype="int16",
+                                        device=self.output_device) as out:
+                    for i in range(0, len(pcm), 8192):
+                        if cancel_evt is not None and cancel_evt.is_set():
+                            logging.info("TTS avbruten.")
+                            out.abort()
+                            return False
+                        if i == 0 and on_first_audio:
+                            on_first_audio()
+                        out.write(pcm[i:i + 8192])
+                return True
+            except Exception as e:
+                logging.error(f"Oväntat TTS-fel: {e}")
+                return False
+
+    def _play_sentences(self, sentences, cancel_evt: Optional[threading.Event] = None,
+                        tee: Optional[bytearray] = None, on_first_audio=None) -> bool:
+        completed = False
+        with self._lock:
+            wav = None
+            abort = threading.Event()
+            chunks = queue.Queue(maxsize=self.prefetch_chunks)
+            producer = threading.Thread(target=self._produce, args=(sentences, chunks, abort),
+                                        name="tts-producer", daemon=True)
+            try:
+                if self.keep_wav:
+                    self.out_dir.mkdir(parents=True, exist_ok=True)
+                    wav = wave.open(str(self.out_dir / f"genio_tts_{uuid.uuid4().hex}.wav"), "wb")
+                    wav.setnchannels(1)
+                    wav.setsampwidth(2)
+                    wav.setframerate(self.sample_rate)
+
+                t0 = time.monotonic()
+                first_audio = None
+                producer.start()
+                with self.output_stream_factory(samplerate=self.sample_rate, channels=1, dtype="int16",
+                                        device=self.output_device) as out:
+                    while True:
+                        if cancel_evt is not None and cancel_evt.is_set():
+                            logging.info("TTS avbruten.")
+                            out.abort()
+                            break
+                        try:
+                            chunk = chunks.get(timeout=0.1)
+                        except queue.Empty:
+                            continue
+                        if chunk is None or chunk is self.FAILED:
+                            # Klart bara om allt syntetiserades och något faktiskt spelades
+                            completed = chunk is None and first_audio is not None
+                            break
+                        if first_audio is None:
+                            first_audio = time.monotonic() - t0
+                            logging.info(f"Spelar upp tal (första ljud efter {first_audio * 1000:.0f} ms)...")
+                            if on_first_audio:
+                                on_first_audio()
+                        out.write(chunk)
+                        if wav:
+                            wav.writeframes(chunk)
+                        if tee is not None:
+                            tee.extend(chunk)
+            except Exception as e:
+                logging.error(f"Oväntat TTS-fel: {e}")
+                completed = False
+            finally:
+                # Producenten tömmer själv Piper i bakgrunden; vänta inte på den
+                abort.set()
+                if wav:
+                    wav.close()
+        return completed
+
+class PromptBank:
+    """Fixed system prompts and earcons, played straight from memory.
+
+    Prompt texts from config are synthesized once with the current Piper
+    voice into ``cache_dir`` as raw PCM, keyed by a hash of the voice model
+    and the text, and memory-mapped at startup. Earcons are short generated
+    tones (e.g. "listening" and "thinking").
+    """
+
+    DEFAULT_TEXTS = {
+        "no_speech": "Jag hörde inget. Försök igen.",
+        "no_reply": "Inget svar från arbetsflödet. Försök igen senare.",
+        "empty_reply": "Jag fick ett tomt svar.",
+        "spooled": "Jag har ingen anslutning just nu. Frågan skickas när anslutningen är tillbaka.",
+    }
+
+    def __init__(self, prompts_cfg: dict, tts: PiperTTS):
+        self.tts = tts
+        self.cache_dir = Path(prompts_cfg.get("cache_dir", "resources/prompt_cache"))
+        self.texts = dict(self.DEFAULT_TEXTS)
+        self.texts.update(prompts_cfg.get("texts") or {})
+        self.earcon_cfg = prompts_cfg.get("earcons") or {}
+        self._audio = {}
+        self._files = []
+
+    def load(self):
+        """Synthesize missing prompts to disk and memory-map all of them."""
+        t0 = time.monotonic()
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            voice = self._voice_hash()
+        except Exception as e:
+            logging.warning(f"Promptcache otillgänglig ({e}), prompter syntetiseras vid behov")
+            return
+
+        for key, text in self.texts.items():
+            digest = hashlib.sha256(f"{voice}\0{self.tts.sample_rate}\0{text}".encode("utf-8")).hexdigest()[:24]
+            path = self.cache_dir / f"{digest}.pcm"
+            try:
+                if not path.exists():
+                    logging.info(f"Syntetiserar prompt '{key}'")
+                    pcm = self.tts.synthesize(text)
+                    if not pcm:
+                        continue
+                    tmp = path.with_suffix(".tmp")
+                    tmp.write_bytes(pcm)
+                    os.replace(tmp, path)
+                f = open(path, "rb")
+                self._files.append(f)
+                self._audio[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except Exception as e:
+                logging.warning(f"Kunde inte ladda prompt '{key}': {e}")
+
+        for key, ecfg in self.earcon_cfg.items():
+            self._audio[key] = self._tone(float(ecfg.get("freq", 880)), int(ecfg.get("ms", 120)),
+                                          float(ecfg.get("volume", 0.3)))
+        logging.info(f"Promptbank laddad: {len(self._audio)} ljud ({(time.monotonic() - t0) * 1000:.0f} ms)")
+
+    def _voice_hash(self) -> str:
+        """SHA-256 of the voice model, cached per file size and mtime."""
+        model = Path(self.tts.model_path)
+        st = model.stat()
+        stamp_path = self.cache_dir / "voice.json"
+        stamp = {"path": str(model.resolve()), "size": st.st_size, "mtime": st.st_mtime}
+        try:
+            with open(stamp_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if {k: saved.get(k) for k in stamp} == stamp:
+                return saved["sha256"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        h = hashlib.sha256()
+        with open(model, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        stamp["sha256"] = h.hexdigest()
+        with open(stamp_path, "w", encoding="utf-8") as f:
+            json.dump(stamp, f)
+        return stamp["sha256"]
+
+    def _tone(self, freq: float, ms: int, volume: float) -> bytes:
+        n = int(self.tts.sample_rate * ms / 1000)
+        t = np.arange(n) / self.tts.sample_rate
+        # Kort in-/uttoning så att tonen inte klickar
+        ramp = np.minimum(1.0, np.minimum(np.arange(n), np.arange(n)[::-1]) / (0.005 * self.tts.sample_rate))
+        tone = np.sin(2 * np.pi * freq * t) * ramp * volume * 32767
+        return tone.astype(np.int16).tobytes()
+
+    def play(self, key: str, cancel_evt: Optional[threading.Event] = None, on_first_audio=None):
+        audio = self._audio.get(key)
+        if audio is not None:
+            self.tts.play_pcm(audio, cancel_evt=cancel_evt, on_first_audio=on_first_audio)
+        elif key in self.texts:
+            self.tts.speak(self.texts[key], cancel_evt=cancel_evt, on_first_audio=on_first_audio)
+
+    def close(self):
+        for audio in self._audio.values():
+            if isinstance(audio, mmap.mmap):
+                audio.close()
+        for f in self._files:
+            f.close()
+        self._audio.clear()
+        self._files.clear()
+
+class TurnTimer:
+    """Monotonic timestamps of the pipeline stages in one turn."""
+
+    def __init__(self, t_wake: Optional[float] = None):
+        self.started = utc_iso()
+        self.marks = {"wake": t_wake if t_wake is not None else time.monotonic()}
+        self.corr_id = None
+        self.cached = False
+        self.local_intent = None
+        self.cancelled = False
+        self.session_id = None
+        self.follow_up = 0  # följdfrågans nummer i sessionen, 0 = startad med väckningsfras
+        # Sätts av uppspelningen när svaret har expect_reply
+        self.expect_reply = False
+        self.keyword = None
+
+    def mark(self, stage: str, t: Optional[float] = None):
+        # Bara första tidpunkten räknas, t.ex. för första ljudet
+        self.marks.setdefault(stage, time.monotonic() if t is None else t)
+
+    def durations(self) -> Dict[str, float]:
+        """Stage durations in seconds, for the stages that were reached."""
+        out = {}
+        for name, (start, end) in LatencyMetrics.STAGES.items():
+            if start in self.marks and end in self.marks:
+                out[name] = self.marks[end] - self.marks[start]
+        return out
+
+class StartupTimeline:
+    """Start/end offsets of the startup steps, for the log and systemd status."""
+
+    def __init__(self):
+        self.t0 = time.monotonic()
+        self.steps: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def run(self, name: str, fn, *args):
+        start = time.monotonic() - self.t0
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.steps[name] = (start, time.monotonic() - self.t0)
+
+    def report(self) -> str:
+        parts = [f"{name} {a:.2f}–{b:.2f} s" for name, (a, b) in sorted(self.steps.items(), key=lambda kv: kv[1])]
+        return ", ".join(parts) + f" (totalt {time.monotonic() - self.t0:.2f} s)"
+
+class LatencyMetrics:
+    """Per-turn latency records and histograms.
+
+    Each finished turn is optionally appended to a JSON-lines file, and
+    histograms per stage are served in Prometheus text format on
+    ``http://<bind>:<prometheus_port>/metrics``.
+    """
+
+    # Steg -> (startmarkering, slutmarkering)
+    STAGES = {
+        "record": ("wake", "speech_end"),
+        "stt": ("stt_start", "stt_end"),
+        "mqtt": ("mqtt_publish", "mqtt_reply"),
+        "mqtt_first_chunk": ("mqtt_publish", "mqtt_first_chunk"),
+        "tts_first_audio": ("tts_start", "tts_first_audio"),
+        "response": ("speech_end", "tts_first_audio"),
+        "playback": ("tts_first_audio", "playback_end"),
+        "turn": ("wake", "playback_end"),
+    }
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0)
+
+    def __init__(self, metrics_cfg: dict):
+        self.jsonl_path = metrics_cfg.get("jsonl_path")
+        self.port = metrics_cfg.get("prometheus_port")
+        self.bind = metrics_cfg.get("bind", "127.0.0.1")
+        self._lock = threading.Lock()
+        self._hist = {name: [0] * (len(self.BUCKETS) + 1) for name in self.STAGES}
+        self._sum = {name: 0.0 for name in self.STAGES}
+        self._turns = {"completed": 0, "cancelled": 0}
+        self._server = None
+
+    def start(self):
+        if not self.port:
+            return
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logging.debug("metrics: " + fmt % args)
+
+        try:
+            self._server = ThreadingHTTPServer((self.bind, int(self.port)), Handler)
+        except OSError as e:
+            logging.error(f"Kunde inte starta metrics-endpoint på {self.bind}:{self.port}: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"Metrics: http://{self.bind}:{self.port}/metrics")
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def record(self, timer: TurnTimer):
+        durations = timer.durations()
+        with self._lock:
+            self._turns["cancelled" if timer.cancelled else "completed"] += 1
+            for name, value in durations.items():
+                self._sum[name] += value
+                i = bisect.bisect_left(self.BUCKETS, value)
+                self._hist[name][i] += 1
+
+        summary = ", ".join(f"{name}={value * 1000:.0f}ms" for name, value in durations.items())
+        logging.info(f"Turtider (corr_id={timer.corr_id}): {summary}")
+
+        if self.jsonl_path:
+            t0 = timer.marks["wake"]
+            record = {
+                "ts": timer.started,
+                "corr_id": timer.corr_id,
+                "cached": timer.cached,
+                "intent": timer.local_intent,
+                "session_id": timer.session_id,
+                "follow_up": timer.follow_up,
+                "cancelled": timer.cancelled,
+                "marks_ms": {k: round((v - t0) * 1000, 1) for k, v in timer.marks.items()},
+                "durations_ms": {k: round(v * 1000, 1) for k, v in durations.items()},
+            }
+            try:
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                logging.warning(f"Kunde inte skriva metrics till {self.jsonl_path}: {e}")
+
+    def render(self) -> str:
+        """Render all histograms in Prometheus text exposition format."""
+        lines = [
+            "# HELP genio_stage_latency_seconds Latency per pipeline stage and turn.",
+            "# TYPE genio_stage_latency_seconds histogram",
+        ]
+        with self._lock:
+            for name in self.STAGES:
+                cumulative = 0
+                for le, count in zip(self.BUCKETS + (float("inf"),), self._hist[name]):
+                    cumulative += count
+                    le_str = "+Inf" if le == float("inf") else repr(le)
+                    lines.append(f'genio_stage_latency_seconds_bucket{{stage="{name}",le="{le_str}"}} {cumulative}')
+                lines.append(f'genio_stage_latency_seconds_sum{{stage="{name}"}} {self._sum[name]:.6f}')
+                lines.append(f'genio_stage_latency_seconds_count{{stage="{name}"}} {cumulative}')
+            lines.append("# HELP genio_turns_total Finished turns by outcome.")
+            lines.append("# TYPE genio_turns_total counter")
+            for outcome, count in self._turns.items():
+                lines.append(f'genio_turns_total{{outcome="{outcome}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+class Prompt(str):
+    """Key of a PromptBank entry queued for playback."""
+
+def build_config_components(cfg: dict) -> Tuple[LocalIntents, AudioUploader]:
+    """Validate the config without loading any model, and build the
+    components that are cheap to create.
+
+    Used both at start and by ``--check-config``; raises ValueError,
+    FileNotFoundError for a missing model or keyword file, or RuntimeError
+    for a missing optional package.
+    """
+    LocalSTT.check_config(cfg["stt"])
+    PiperTTS.check_config(cfg["tts"])
+    Recorder.keywords_from_config(cfg["wakeword"])
+    intents = LocalIntents(cfg.get("intents", {}) or {})
+    uploader = AudioUploader(cfg["stt"].get("remote", {}) or {}, int(cfg["audio"].get("sample_rate", 16000)))
+    return intents, uploader
 
 class GenioAIApp:
+    """Voice assistant pipeline run as concurrent stages.
+
+    Capture, wakeword, turn handling (record, STT, request) and playback run
+    on dedicated threads connected by queues. The wakeword stage keeps running
+    while a reply is played, so saying the wakeword again interrupts the
+    current turn (barge-in): its TTS is stopped and its request abandoned.
+    """
+
+    # Signaltoner som väntat längre än så i uppspelningskön spelas inte (sekunder)
+    EARCON_MAX_DELAY = 0.3
+
     def __init__(self, cfg):
         self.cfg = cfg
         self.lang = cfg.get("stt", {}).get("language", "sv")
 
-        try:
-            self.rec = Recorder(cfg["audio"], cfg["wakeword"])
-            self.stt = LocalSTT(cfg["stt"], self.rec.sample_rate)
-            self.tts = PiperTTS(cfg["tts"])
-            self.mqtt = MqttClient(cfg["mqtt"])
-        except Exception as e:
-            logging.error(f"Fel vid initialisering av komponenter: {e}")
-            raise
+        self.rec = self.stt = self.tts = self.mqtt = self.prompts = None
+        self._control_lock = threading.Lock()
+        self._pending_control = None
+        # Billiga delar med konfigurationsvalidering först, så att fel syns innan modellerna laddas
+        self.intents, self.uploader = build_config_components(cfg)
+        self.timeline = StartupTimeline()
+        self._init_components()
+        logging.info(f"Starttidslinje: {self.timeline.report()}")
 
+        self.barge_in = bool(cfg.get("audio", {}).get("barge_in", True))
+        self.stream_replies = bool(cfg["mqtt"].get("stream_replies", True))
+        self.cache = ResponseCache(cfg.get("cache", {}))
+        conv_cfg = cfg.get("conversation", {}) or {}
+        self.follow_up = bool(conv_cfg.get("follow_up", True))
+        self.follow_up_timeout = float(conv_cfg.get("timeout_sec", 5))
+        self.max_follow_ups = int(conv_cfg.get("max_follow_ups", 5))
+        self.metrics = LatencyMetrics(cfg.get("metrics", {}))
         self.stop_evt = threading.Event()
         self._shutdown_requested = False
+        self._wake_q = queue.Queue()
+        self._play_q = queue.Queue()
+        self._turn_lock = threading.Lock()
+        self._turn_cancel = threading.Event()
+        self._turn_active = False
         signal.signal(signal.SIGINT, self._sig_handler)
         signal.signal(signal.SIGTERM, self._sig_handler)
 
+    def _init_components(self):
+        """Load the components concurrently.
+
+        Whisper, Porcupine, Piper and the TLS connect to the broker are
+        independent and mostly spend their time in native code or on the
+        network, so they are started together; the slowest decides start time.
+        """
+        cfg = self.cfg
+        tl = self.timeline
+
+        def load_stt():
+            stt = tl.run("stt", LocalSTT, cfg["stt"], int(cfg["audio"].get("sample_rate", 16000)))
+            # Kör en första avkodning nu så att första riktiga turen slipper kallstarten
+            if cfg["stt"].get("warmup", True):
+                tl.run("stt_warmup", stt.warmup)
+            with self._control_lock:
+                self.stt = stt
+                pending, self._pending_control = self._pending_control, None
+            if pending:
+                self._apply_control(pending)
+
+        def load_tts():
+            self.tts = tl.run("tts", PiperTTS, cfg["tts"])
+            if cfg["tts"].get("warmup", True):
+                tl.run("tts_warmup", self.tts.warmup)
+            self.prompts = PromptBank(cfg.get("prompts", {}), self.tts)
+            tl.run("prompts", self.prompts.load)
+
+        def load_mqtt():
+            self.mqtt = tl.run("mqtt", MqttClient, cfg["mqtt"])
+            self.mqtt.on_control = self._on_control
+            try:
+                tl.run("mqtt_connect", self.mqtt.connect)
+            except Exception as e:
+                logging.error(f"Kunde inte ansluta till MQTT: {e}")
+                raise
+
+        def load_recorder():
+            self.rec = tl.run("recorder", Recorder, cfg["audio"], cfg["wakeword"])
+
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix="init") as pool:
+            futs = [pool.submit(fn) for fn in (load_stt, load_tts, load_mqtt, load_recorder)]
+        errors = [f.exception() for f in futs if f.exception() is not None]
+        if errors:
+            logging.error(f"Fel vid initialisering av komponenter: {errors[0]}")
+            # Stäng det som hann starta så att Piper-processen och MQTT-tråden inte blir kvar
+            for comp in (self.rec, self.prompts, self.tts, self.mqtt):
+                if comp is not None:
+                    comp.close()
+            raise errors[0]
+
+    def _on_control(self, data: Dict[str, Any]):
+        """Control message from ``mqtt.control_topic`` (paho thread)."""
+        with self._control_lock:
+            if self.stt is None:
+                # Behållna meddelanden kan komma innan Whisper hunnit laddas
+                self._pending_control = data
+                return
+        self._apply_control(data)
+
+    def _apply_control(self, data: Dict[str, Any]):
+        if "vocabulary" in data or "initial_prompt" in data:
+            vocabulary = data.get("vocabulary", self.stt.vocabulary)
+            initial_prompt = data.get("initial_prompt", self.stt.initial_prompt)
+            if vocabulary is not None and not (isinstance(vocabulary, list)
+                                               and all(isinstance(w, str) for w in vocabulary)):
+                logging.warning("Styrmeddelande ignorerat: vocabulary måste vara en lista med strängar")
+                return
+            if initial_prompt is not None and not isinstance(initial_prompt, str):
+                logging.warning("Styrmeddelande ignorerat: initial_prompt måste vara en sträng")
+                return
+            self.stt.set_vocabulary(initial_prompt, vocabulary)
+        else:
+            logging.warning(f"Okänt styrmeddelande: {sorted(data)}")
+
     def _sig_handler(self, signum, frame):
         if not self._shutdown_requested:
             self._shutdown_requested = True
             sig_name = signal.Signals(signum).name
             logging.info(f"Mottog signal {sig_name}, avslutar graciöst...")
             self.stop_evt.set()
+            self._turn_cancel.set()
 
-    def run(self):
-        """Main application loop."""
-        logging.info("Genio AI startar...")
-        
+    def _wake_loop(self):
+        """Wakeword stage: runs continuously, also during playback."""
+        while not self.stop_evt.is_set():
+            try:
+                for pos, kw in self.rec.wakeword_events(self.stop_evt):
+                    if kw.command == "stop":
+                        self._stop_command()
+                        continue
+                    with self._turn_lock:
+                        if self._turn_active:
+                            if self.barge_in:
+                                logging.info("Barge-in: avbryter pågående tur.")
+                                self._turn_cancel.set()
+                            else:
+                                # Nästa tur spelas in medan föregående väntar på n8n
+                                logging.debug("Väckningsfras under pågående tur, köar ny tur")
+                    self._wake_q.put((pos, time.monotonic(), kw, None))
+            except Exception as e:
+                logging.exception(f"Oväntat fel i wakeword-steget: {e}")
+                self.stop_evt.wait(2)
+
+    def _stop_command(self):
+        """Local "stop" keyword: drop queued turns and cancel the current one."""
+        logging.info("Stoppkommando: avbryter pågående tur.")
+        while True:
+            try:
+                self._wake_q.get_nowait()
+            except queue.Empty:
+                break
+        with self._turn_lock:
+            if self._turn_active:
+                self._turn_cancel.set()
+
+    def _turn_loop(self):
+        """Turn stage: record, transcribe and send to n8n for each wakeword."""
+        while not self.stop_evt.is_set():
+            try:
+                pos, t_wake, kw, follow = self._wake_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            cancel = threading.Event()
+            timer = TurnTimer(t_wake)
+            timer.keyword = kw
+            # En session är en väckningsfras plus dess följdfrågor
+            timer.session_id, timer.follow_up = follow if follow else (str(uuid.uuid4()), 0)
+            with self._turn_lock:
+                self._turn_cancel = cancel
+                self._turn_active = True
+            try:
+                self._handle_turn(pos, cancel, timer, kw)
+            except Exception as e:
+                logging.exception(f"Oväntat fel i huvudloopen: {e}")
+                # Wait before retrying to avoid rapid error loops
+                self.stop_evt.wait(2)
+            finally:
+                # Turen räknas som aktiv tills uppspelningen är klar
+                self._play_q.put((None, cancel, timer, time.monotonic()))
+
+    def _handle_turn(self, pos: int, cancel: threading.Event, timer: "TurnTimer",
+                     kw: Optional[WakeKeyword] = None):
+        self._say(Prompt("listening"), cancel)
+        # Nyckelordet kan styra språk och n8n-arbetsflöde för turen
+        lang = (kw.language if kw else None) or self.lang
+        topic = kw.request_topic if kw else None
+
+        # Step 2: Record utterance and convert to text
+        remote = self.uploader.available()
+        inc = self.stt.start_incremental(language=lang) if self.stt.incremental and not remote else None
+        pcm, speech_flags, heard = self.rec.record_utterance(
+            on_frame=inc.feed if inc else None, start_pos=pos, cancel_evt=cancel,
+            speech_timeout=self.follow_up_timeout if timer.follow_up else None)
+        timer.mark("speech_end")
+        if timer.follow_up and not heard:
+            if inc:
+                inc.cancel()
+            logging.info("Ingen följdfråga, samtalet avslutas.")
+            return
+        if cancel.is_set() or pcm.size < self.rec.sample_rate * 0.2:
+            if inc:
+                inc.cancel()
+            if not cancel.is_set():
+                logging.info("Tomt/kort yttrande. Återgår till lyssning.")
+            return
+
+        corr_id = None
+        if remote:
+            if not heard:
+                self._say(Prompt("no_speech"), cancel, timer)
+                return
+            # Textrequesten vid fallback får samma corr_id som uppladdningen, så att
+            # arbetsflödet kan se att en sen serverbehandling gäller samma fråga
+            corr_id = str(uuid.uuid4())
+            if self._upload_turn(pcm, lang, topic, cancel, timer, corr_id):
+                return
+
+        # Transkribera direkt från PCM-array (ingen fil-avkodning; undviker PyAV-behov)
+        timer.mark("stt_start")
+        text = inc.finish(speech_flags) if inc else self.stt.transcribe_pcm(pcm, speech_flags, self.rec.frame_ms, language=lang)
+        timer.mark("stt_end")
+        if cancel.is_set():
+            return
+
+        if not text:
+            self._say(Prompt("no_speech"), cancel, timer)
+            return
+        self.stt.remember(text)
+
+        intent = self.intents.match(text)
+        if intent is not None:
+            logging.info(f"Lokal intent '{intent.name}', hoppar över MQTT")
+            timer.local_intent = intent.name
+            reply = intent.run()
+            if reply and not cancel.is_set():
+                self._say(reply, cancel, timer)
+            return
+
+        # Följdfrågor ("ja", "nej") hör till sitt samtal och får aldrig besvaras ur cachen
+        cached = self.cache.get(text, lang, topic) if not timer.follow_up else None
+        if cached is not None:
+            logging.info("Svar från lokal cache, hoppar över MQTT")
+            timer.cached = True
+            self._say(cached, cancel, timer)
+            return
+
+        self._say(Prompt("thinking"), cancel)
+
+        # Step 3: Send to n8n via MQTT; svaret väntas in av uppspelningssteget
+        # så att nästa tur kan spelas in och transkriberas under tiden
+        self._queue_reply(self._submit(text, lang, topic, timer, corr_id=corr_id), cancel, timer)
+
+    def _submit(self, text: Optional[str], lang: str, topic: Optional[str], timer: "TurnTimer",
+                audio: Optional[Dict[str, Any]] = None, corr_id: Optional[str] = None) -> RequestFuture:
+        chunks = queue.Queue() if self.stream_replies else None
+        fut = self.mqtt.submit(
+            text=text,
+            lang=lang,
+            qos=self.cfg["mqtt"].get("qos", 1),
+            timeout=int(self.cfg["mqtt"].get("timeout_sec", 15)),
+            on_chunk=chunks.put if chunks else None,
+            topic=topic,
+            session_id=timer.session_id,
+            audio=audio,
+            corr_id=corr_id,
+        )
+        if chunks:
+            fut.add_done_callback(lambda f: chunks.put(None))
+            fut.chunks = chunks
+        return fut
+
+    def _queue_reply(self, fut: RequestFuture, cancel: threading.Event, timer: "TurnTimer"):
+        timer.mark("mqtt_publish", fut.t_publish)
+        timer.corr_id = fut.corr_id
+        fut.add_done_callback(lambda f: timer.mark("mqtt_reply"))
+        self._say(fut, cancel, timer)
+
+    def _upload_turn(self, pcm: np.ndarray, lang: str, topic: Optional[str],
+                     cancel: threading.Event, timer: "TurnTimer", corr_id: str) -> bool:
+        """Send the recording for server-side STT; False means transcribe locally."""
         try:
-            self.mqtt.connect()
+            audio = self.uploader.encode(pcm)
         except Exception as e:
-            logging.error(f"Kunde inte ansluta till MQTT: {e}")
-            return
-        
-        logging.info("Genio AI redo. Lyssnar efter väckningsfras.")
-        
-        while not self.stop_evt.is_set():
+            logging.error(f"Kunde inte koda ljud för fjärr-STT: {e}")
+            return False
+        fut = self._submit(None, lang, topic, timer, audio=audio, corr_id=corr_id)
+        deadline = fut.t_publish + self.uploader.fallback_sec
+        while not fut.acked.wait(0.05):
+            if cancel.is_set():
+                fut.cancel()
+                return True
+            if time.monotonic() >= deadline:
+                break
+        failed = fut.done() and (fut.cancelled() or fut.exception() is not None)
+        if fut.acked.is_set() and not failed:
+            logging.info(f"Fjärr-STT tog emot {len(audio['data'])} bytes ({audio['codec']})")
+            if fut.text:
+                self.stt.remember(fut.text)
+            self._say(Prompt("thinking"), cancel)
+            self._queue_reply(fut, cancel, timer)
+            return True
+        fut.cancel()
+        self.uploader.mark_slow()
+        why = "misslyckades" if failed else f"svarade inte inom {self.uploader.fallback_sec:.1f} s"
+        logging.warning(f"Fjärr-STT {why}, transkriberar lokalt "
+                        f"(nästa försök om {self.uploader.cooldown_sec:.0f} s)")
+        return False
+
+    def _say(self, item, cancel: threading.Event, timer: Optional["TurnTimer"] = None):
+        """Queue text, a pending MQTT reply Future or a cache entry for playback.
+
+        Items queued with the turn's ``timer`` count as the turn's answer for
+        the first-audio timing; earcons are queued without it.
+        """
+        self._play_q.put((item, cancel, timer, time.monotonic()))
+
+    def _reply_text(self, resp: Optional[Dict[str, Any]]) -> str:
+        if resp is None:
+            return self.prompts.texts["no_reply"]
+        reply_text = resp.get("reply") or resp.get("text") or ""
+        if not reply_text:
+            reply_text = self.prompts.texts["empty_reply"]
+        return reply_text
+
+    def _next_chunk(self, fut: RequestFuture, cancel: threading.Event) -> Optional[str]:
+        """Wait for the next streamed chunk; None when the reply is complete or cancelled."""
+        while not cancel.is_set():
             try:
-                # Step 1: Listen for wakeword
-                self.rec.listen_for_wakeword(self.stop_evt)
-                if self.stop_evt.is_set():
-                    break
+                return fut.chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
 
-                # Step 2: Record utterance and convert to text
-                pcm = self.rec.record_utterance()
-                if not pcm or len(pcm) < self.rec.sample_rate * 2 * 0.2:
-                    logging.info("Tomt/kort yttrande. Återgår till lyssning.")
-                    continue
+    def _reply_chunks(self, fut: RequestFuture, first: str, cancel: threading.Event):
+        """Yield reply text chunks as they arrive, starting with ``first``."""
+        chunk = first
+        while chunk is not None:
+            yield chunk
+            chunk = self._next_chunk(fut, cancel)
+        if cancel.is_set():
+            fut.cancel()
 
-                # Transkribera direkt från PCM-array (ingen fil-avkodning; undviker PyAV-behov)
-                text = self.stt.transcribe_pcm(pcm)
+    def _play_reply(self, fut: RequestFuture, cancel: threading.Event, timer: "TurnTimer"):
+        """Speak an MQTT reply and cache it (with its audio) if allowed."""
+        pcm = bytearray() if self.cache.enabled else None
+        first_audio = lambda: timer.mark("tts_first_audio")
+        if fut.done() and not fut.cancelled() and isinstance(fut.exception(), RequestSpooled):
+            timer.mark("tts_start")
+            self.prompts.play("spooled", cancel_evt=cancel, on_first_audio=first_audio)
+            return
+        first = self._next_chunk(fut, cancel) if fut.chunks is not None else None
+        if first is not None:
+            # tts_start först när texten finns, så att TTS-steget inte räknar in n8n:s svarstid
+            timer.mark("mqtt_first_chunk")
+            timer.mark("tts_start")
+            completed = self.tts.speak_stream(self._reply_chunks(fut, first, cancel), cancel_evt=cancel, tee=pcm,
+                                              on_first_audio=first_audio)
+            resp = fut.result() if fut.done() and not fut.cancelled() and not fut.exception() else None
+        else:
+            # Ej strömmat, eller arbetsflödet svarade med ett enda meddelande (eller inte alls);
+            # timeout och tomt svar spelas då från promptbanken i stället för att syntetiseras
+            resp = self.mqtt.wait_reply(fut, cancel_evt=cancel)
+            if cancel.is_set():
+                return
+            timer.mark("tts_start")
+            if resp is None:
+                self.prompts.play("no_reply", cancel_evt=cancel, on_first_audio=first_audio)
+                return
+            if not (resp.get("reply") or resp.get("text")):
+                self.prompts.play("empty_reply", cancel_evt=cancel, on_first_audio=first_audio)
+                return
+            completed = self.tts.speak(self._reply_text(resp), cancel_evt=cancel, tee=pcm,
+                                       on_first_audio=first_audio)
+        timer.expect_reply = bool(completed and resp and resp.get("expect_reply"))
+        # Svar i ett samtal cachas inte: n8n måste se varje tur i sessionen
+        in_session = timer.follow_up or (resp and resp.get("expect_reply"))
+        if resp and fut.text and not in_session and (resp.get("reply") or resp.get("text")):
+            entry = self.cache.put(fut.text, fut.lang, resp, fut.topic)
+            if entry is not None and completed:
+                self.cache.set_pcm(entry, bytes(pcm))
 
-                if not text:
-                    self.tts.speak("Jag hörde inget. Försök igen.")
-                    continue
+    def _play_cached(self, entry: CacheEntry, cancel: threading.Event, timer: "TurnTimer"):
+        first_audio = lambda: timer.mark("tts_first_audio")
+        timer.mark("tts_start")
+        timer.expect_reply = bool(entry.response.get("expect_reply"))
+        if entry.pcm:
+            self.tts.play_pcm(entry.pcm, cancel_evt=cancel, on_first_audio=first_audio)
+            return
+        pcm = bytearray()
+        if self.tts.speak(self._reply_text(entry.response), cancel_evt=cancel, tee=pcm,
+                          on_first_audio=first_audio):
+            self.cache.set_pcm(entry, bytes(pcm))
 
-                # Step 3: Send to n8n via MQTT and wait for response
-                resp = self.mqtt.request_reply(
-                    text=text,
-                    lang=self.lang,
-                    qos=self.cfg["mqtt"].get("qos", 1),
-                    timeout=int(self.cfg["mqtt"].get("timeout_sec", 15))
-                )
-
-                # Step 4: Speak the response
-                if resp is None:
-                    self.tts.speak("Inget svar från arbetsflödet. Försök igen senare.")
-                else:
-                    reply_text = resp.get("reply") or resp.get("text") or ""
-                    if not reply_text:
-                        reply_text = "Jag fick ett tomt svar."
-                    self.tts.speak(reply_text)
+    def _follow_up_turn(self, timer: "TurnTimer") -> bool:
+        """Start recording the answer to a reply that asked a question."""
+        if not self.follow_up or self.stop_evt.is_set():
+            return False
+        if timer.follow_up >= self.max_follow_ups:
+            logging.info("Max antal följdfrågor nått, väntar på väckningsfras.")
+            return False
+        logging.info("Svaret väntar på svar, lyssnar efter följdfråga.")
+        # Direkt från samma inspelningsström, utan ny väckningsfras
+        self._wake_q.put((self.rec.capture.position, time.monotonic(), timer.keyword,
+                          (timer.session_id, timer.follow_up + 1)))
+        return True
 
+    def _playback_loop(self):
+        """Playback stage: speaks replies until cancelled by barge-in."""
+        while not self.stop_evt.is_set():
+            try:
+                item, cancel, timer, queued = self._play_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is None:
+                # Markör för turens slut
+                with self._turn_lock:
+                    if self._turn_cancel is cancel:
+                        self._turn_active = False
+                timer.mark("playback_end")
+                timer.cancelled = cancel.is_set()
+                self.metrics.record(timer)
+                if timer.expect_reply and not cancel.is_set() and self._follow_up_turn(timer):
+                    continue
                 # Step 5: Ready for next wakeword
                 logging.info("Redo för ny väckningsfras.")
-                
-            except KeyboardInterrupt:
-                logging.info("Avbruten av användaren")
-                break
+                continue
+            first_audio = (lambda t=timer: t.mark("tts_first_audio")) if timer else None
+            try:
+                if isinstance(item, RequestFuture):
+                    # Step 4: Speak the response
+                    self._play_reply(item, cancel, timer)
+                elif isinstance(item, CacheEntry):
+                    self._play_cached(item, cancel, timer)
+                elif isinstance(item, Prompt):
+                    if timer is None and time.monotonic() - queued > self.EARCON_MAX_DELAY:
+                        # Utan barge-in kan en signalton köas bakom föregående svar; spelad
+                        # så sent hamnar den mitt i nästa inspelning
+                        logging.debug(f"Hoppar över inaktuell signalton '{item}'")
+                    elif not cancel.is_set():
+                        self.prompts.play(item, cancel_evt=cancel, on_first_audio=first_audio)
+                elif not cancel.is_set():
+                    self.tts.speak(item, cancel_evt=cancel, on_first_audio=first_audio)
             except Exception as e:
-                logging.exception(f"Oväntat fel i huvudloopen: {e}")
-                # Wait before retrying to avoid rapid error loops
-                time.sleep(2)
+                logging.exception(f"Oväntat fel vid uppspelning: {e}")
+
+    def run(self):
+        """Start the pipeline stages and wait for shutdown."""
+        logging.info("Genio AI startar...")
+
+        self.rec.start()
+        self.metrics.start()
+        stages = [
+            threading.Thread(target=self._wake_loop, name="wakeword", daemon=True),
+            threading.Thread(target=self._turn_loop, name="turn", daemon=True),
+            threading.Thread(target=self._playback_loop, name="playback", daemon=True),
+        ]
+        for t in stages:
+            t.start()
+        logging.info("Genio AI redo. Lyssnar efter väckningsfras.")
+        sd_notify(f"READY=1\nSTATUS=Redo, start {time.monotonic() - self.timeline.t0:.1f} s")
+
+        try:
+            # Huvudtråden väntar bara; signaler hanteras här
+            while not self.stop_evt.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            logging.info("Avbruten av användaren")
+            self.stop_evt.set()
 
         logging.info("Stänger ner...")
+        sd_notify("STOPPING=1")
+        self._turn_cancel.set()
+        for t in stages:
+            t.join(timeout=5)
+        self.rec.close()
+        self.metrics.close()
+        self.prompts.close()
+        self.tts.close()
         self.mqtt.close()
         logging.info("Genio AI avslutad.")
 
+class FakeInputStream:
+    """Stand-in for ``sd.RawInputStream`` that plays queued PCM instead of a mic.
+
+    Queued clips are delivered at ``speed`` times real time, with silence in
+    between. ``clip_end`` is the monotonic time the last sample of the most
+    recent clip was delivered, ``speech_end`` the time its sample at the
+    ``speech_end`` offset given to ``play`` was.
+    """
+
+    def __init__(self, samplerate, blocksize, dtype="int16", channels=1, device=None, speed: float = 1.0):
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.speed = speed
+        self._clips = queue.Queue()
+        self._current = None
+        self._next_t = None
+        self.clip_end = None
+        self.speech_end = None
+        self._speech_left = None
+        self.clip_done = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def play(self, pcm: np.ndarray, speech_end: Optional[int] = None):
+        self.clip_done.clear()
+        self.speech_end = None
+        self._clips.put((pcm, speech_end))
+
+    def read(self, frames: int):
+        # Takta leveransen så att endpointing mäts i (skalad) realtid
+        now = time.monotonic()
+        if self._next_t is None:
+            self._next_t = now
+        delay = self._next_t - now
+        if delay > 0:
+            time.sleep(delay)
+        self._next_t += frames / self.samplerate / self.speed
+
+        out = np.zeros(frames, dtype=np.int16)
+        filled = 0
+        while filled < frames:
+            if self._current is None or not len(self._current):
+                try:
+                    self._current, self._speech_left = self._clips.get_nowait()
+                except queue.Empty:
+                    break
+            n = min(frames - filled, len(self._current))
+            out[filled:filled + n] = self._current[:n]
+            self._current = self._current[n:]
+            filled += n
+            if self._speech_left is not None:
+                self._speech_left -= n
+                if self._speech_left <= 0:
+                    self.speech_end = time.monotonic()
+                    self._speech_left = None
+            if not len(self._current):
+                self.clip_end = time.monotonic()
+                self.clip_done.set()
+        return out.tobytes(), False
+
+class FakeOutputStream:
+    """Stand-in for ``sd.RawOutputStream`` that discards audio.
+
+    With ``speed > 0`` writes block like a real device at that multiple of
+    real time; with ``speed == 0`` they return immediately.
+    """
+
+    def __init__(self, samplerate, channels=1, dtype="int16", device=None, speed: float = 0.0):
+        self.samplerate = samplerate
+        self.speed = speed
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, data):
+        n = len(data) // 2
+        self.frames += n
+        if self.speed > 0:
+            time.sleep(n / self.samplerate / self.speed)
+
+    def abort(self):
+        pass
+
+class LoopbackMqttClient:
+    """In-process stand-in for the paho client plus an n8n responder.
+
+    Every published request is answered on its ``reply_topic`` after
+    ``delay`` seconds by echoing the text, streamed in two chunks when the
+    request asks for streaming.
+    """
+
+    def __init__(self, delay: float = 0.3):
+        self.delay = delay
+        self.on_message = None
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        req = json.loads(payload)
+        threading.Timer(self.delay, self._respond, args=(req,)).start()
+        return type("PublishResult", (), {"rc": 0})()
+
+    def _respond(self, req: dict):
+        reply = f"Du sa: {req['text']}. Det här är ett lokalt testsvar."
+        if req.get("stream"):
+            head, tail = reply.split(". ", 1)
+            messages = [{"seq": 0, "reply": head + ". "}, {"seq": 1, "reply": tail, "final": True}]
+        else:
+            messages = [{"reply": reply}]
+        for msg in messages:
+            msg["corr_id"] = req["corr_id"]
+            message = type("Message", (), {"topic": req["reply_topic"], "payload": json.dumps(msg).encode("utf-8")})
+            self.on_message(None, None, message())
+
+def _load_wav(path: Path, sample_rate: int) -> np.ndarray:
+    """Read a 16-bit WAV as mono int16 at ``sample_rate``."""
+    with wave.open(str(path), "rb") as w:
+        if w.getsampwidth() != 2:
+            raise ValueError(f"{path}: bara 16-bitars WAV stöds")
+        pcm = np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16)
+        if w.getnchannels() > 1:
+            pcm = pcm.reshape(-1, w.getnchannels()).mean(axis=1).astype(np.int16)
+        rate = w.getframerate()
+    if rate != sample_rate:
+        t = np.arange(int(len(pcm) * sample_rate / rate)) * (rate / sample_rate)
+        pcm = np.interp(t, np.arange(len(pcm)), pcm).astype(np.int16)
+    return pcm
+
+def _speech_end_sample(clip: np.ndarray, rec: "Recorder", audio_cfg: dict) -> Optional[int]:
+    """Sample offset just after the last speech frame in ``clip``, by the recorder's gate."""
+    ep = Endpointer(audio_cfg, rec.sample_rate, rec.frame_ms, rec.vad)
+    ep.noise_floor = rec.endpointer.noise_floor
+    # Pauser i klippet får inte avsluta klassningen i förtid
+    ep.silence_frames = len(clip)
+    flags, _ = ep.push(clip)
+    speech = np.flatnonzero(flags)
+    return int(speech[-1] + 1) * ep.frame_size if speech.size else None
+
+def bench_main(argv: List[str]) -> int:
+    """Replay WAV files through endpointing, STT, a loopback MQTT responder and TTS."""
+    import argparse
+    import resource
+
+    parser = argparse.ArgumentParser(prog="genio_ai.py bench", description=bench_main.__doc__)
+    parser.add_argument("wav_dir", help="katalog med 16-bitars WAV-filer, en fråga per fil")
+    parser.add_argument("--config", default=os.environ.get("GENIO_CONFIG", "config.yaml"))
+    parser.add_argument("--speed", type=float, default=1.0, help="inspelningstakt i förhållande till realtid")
+    parser.add_argument("--reply-delay", type=float, default=0.3, help="simulerad n8n-svarstid (s)")
+    parser.add_argument("--no-tts", action="store_true", help="hoppa över talsyntes")
+    parser.add_argument("--json", action="store_true", help="skriv resultatet som JSON")
+    args = parser.parse_args(argv)
+
+    cfg = load_config(args.config)
+    wavs = sorted(Path(args.wav_dir).glob("*.wav"))
+    if not wavs:
+        logging.error(f"Inga WAV-filer i {args.wav_dir}")
+        return 1
+
+    inputs = []
+
+    def input_factory(**kwargs):
+        stream = FakeInputStream(speed=args.speed, **kwargs)
+        inputs.append(stream)
+        return stream
+
+    t_init = time.monotonic()
+    rec = Recorder(cfg["audio"], None, input_stream_factory=input_factory)
+    stt = LocalSTT(cfg["stt"], rec.sample_rate)
+    tts = None if args.no_tts else PiperTTS(cfg["tts"], output_stream_factory=FakeOutputStream)
+    loopback = LoopbackMqttClient(args.reply_delay)
+    # Benchmarken får inte röra enhetens offlinekö
+    client = MqttClient(dict(cfg["mqtt"], spool={"enabled": False}), client=loopback)
+    loopback.on_message = client._on_message
+    client._connected_evt.set()
+    init_sec = time.monotonic() - t_init
+
+    rec.start()
+    while not inputs:
+        time.sleep(0.01)
+    mic = inputs[0]
+    lang = cfg["stt"].get("language", "sv")
+    results = []
+    audio_sec = 0.0
+    stt_sec = 0.0
+    usage0 = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    t_run = time.monotonic()
+    try:
+        for path in wavs:
+            clip = _load_wav(path, rec.sample_rate)
+            audio_sec += len(clip) / rec.sample_rate
+            timer = TurnTimer()
+            start = rec.capture.position
+            # Endpointing mäts från slutet av talet, inte klippets tystnad efteråt
+            mic.play(clip, _speech_end_sample(clip, rec, cfg["audio"]))
+            pcm, flags, _ = rec.record_utterance(start_pos=start)
+            timer.mark("speech_end")
+            mic.clip_done.wait(timeout=len(clip) / rec.sample_rate / args.speed + 5)
+            endpoint = timer.marks["speech_end"] - mic.speech_end if mic.speech_end else None
+
+            timer.mark("stt_start")
+            text = stt.transcribe_pcm(pcm, flags, rec.frame_ms)
+            timer.mark("stt_end")
+            stt_sec += timer.marks["stt_end"] - timer.marks["stt_start"]
+
+            fut = client.submit(text or "(tyst)", lang, timeout=10)
+            timer.corr_id = fut.corr_id
+            timer.mark("mqtt_publish")
+            resp = client.wait_reply(fut)
+            timer.mark("mqtt_reply")
+
+            if tts is not None and resp:
+                timer.mark("tts_start")
+                tts.speak(resp.get("reply", ""), on_first_audio=lambda: timer.mark("tts_first_audio"))
+            timer.mark("playback_end")
+
+            durations = timer.durations()
+            if endpoint is not None:
+                durations["endpoint"] = endpoint
+            results.append({"file": path.name, "text": text, "durations": durations})
+            logging.info(f"{path.name}: '{text}'")
+    finally:
+        client.close()
+        rec.close()
+        if tts is not None:
+            tts.close()
+    wall = time.monotonic() - t_run
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    stages = sorted({k for r in results for k in r["durations"]})
+    percentiles = {}
+    for stage in stages:
+        values = np.array([r["durations"][stage] for r in results if stage in r["durations"]]) * 1000
+        percentiles[stage] = {
+            "p50_ms": round(float(np.percentile(values, 50)), 1),
+            "p95_ms": round(float(np.percentile(values, 95)), 1),
+            "max_ms": round(float(values.max()), 1),
+            "n": int(values.size),
+        }
+    report = {
+        "files": len(results),
+        "audio_sec": round(audio_sec, 2),
+        "init_sec": round(init_sec, 2),
+        "wall_sec": round(wall, 2),
+        "stt_rtf": round(stt_sec / audio_sec, 3) if audio_sec else None,
+        "stt_fallbacks": stt.fallbacks,
+        "cpu_sec": round((self_ru.ru_utime + self_ru.ru_stime) - (usage0[0].ru_utime + usage0[0].ru_stime), 2),
+        "cpu_children_sec": round((child_ru.ru_utime + child_ru.ru_stime) - (usage0[1].ru_utime + usage0[1].ru_stime), 2),
+        "peak_rss_mb": round(self_ru.ru_maxrss / 1024, 1),
+        "peak_rss_children_mb": round(child_ru.ru_maxrss / 1024, 1),
+        "stages": percentiles,
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return 0
+    print(f"Filer: {report['files']}  ljud: {report['audio_sec']} s  vägg: {report['wall_sec']} s  init: {report['init_sec']} s")
+    print(f"STT RTF: {report['stt_rtf']} ({report['stt_fallbacks']} omavkodningar)  CPU: {report['cpu_sec']} s (+{report['cpu_children_sec']} s Piper)  "
+          f"topp-RSS: {report['peak_rss_mb']} MB (Piper {report['peak_rss_children_mb']} MB)")
+    print(f"{'steg':<18}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'n':>5}")
+    for stage, p in percentiles.items():
+        print(f"{stage:<18}{p['p50_ms']:>10}{p['p95_ms']:>10}{p['max_ms']:>10}{p['n']:>5}")
+    return 0
+
+def check_environment(cfg: dict, cfg_path: str) -> bool:
+    """Check that the env vars named in the config are set; prints help if not."""
+    # Validate environment variables (only check names, never log values)
+    # Note: We only log environment variable NAMES (e.g., "MQTT_PASSWORD"),
+    # never the actual sensitive values
+    required_env_vars = [
+        cfg["wakeword"]["access_key_env"],
+        cfg["mqtt"]["username_env"],
+        cfg["mqtt"]["password_env"]
+    ]
+    
+    missing_vars = []
+    empty_vars = []
+    for env_var_name in required_env_vars:
+        value = os.environ.get(env_var_name)
+        if value is None:
+            missing_vars.append(env_var_name)
+        elif not value.strip():
+            empty_vars.append(env_var_name)
+    
+    if missing_vars or empty_vars:
+        all_invalid = missing_vars + empty_vars
+        # Safe: Log only variable names, not values
+        logging.error(f"Saknade eller tomma miljövariabler: {', '.join(all_invalid)}")
+        print(f"\n❌ Följande miljövariabler måste sättas korrekt:", file=sys.stderr)
+        for env_var_name in all_invalid:
+            # Safe: Only printing variable name, no sensitive data
+            if env_var_name in missing_vars:
+                print(f"  - {env_var_name} (inte satt i miljön)", file=sys.stderr)
+            else:
+                print(f"  - {env_var_name} (tom eller endast whitespace)", file=sys.stderr)
+        
+        print(f"\n💡 Felsökning:", file=sys.stderr)
+        print(f"  1. Kontrollera att du stavat variabelnamnen rätt", file=sys.stderr)
+        # Safe: At least one list is non-empty due to the condition above
+        first_var = missing_vars[0] if missing_vars else empty_vars[0]
+        print(f"  2. Kör 'echo ${first_var}' för att verifiera värdet", file=sys.stderr)
+        print(f"  3. Exportera variabler i SAMMA terminal där du kör scriptet", file=sys.stderr)
+        
+        print(f"\n📝 Exempel på korrekt användning:", file=sys.stderr)
+        print(f"  export PORCUPINE_ACCESS_KEY=\"your_key_here\"", file=sys.stderr)
+        print(f"  export MQTT_USERNAME=\"your_username\"", file=sys.stderr)
+        print(f"  export MQTT_PASSWORD=\"your_password\"", file=sys.stderr)
+        print(f"  python3 genio_ai.py", file=sys.stderr)
+        
+        print(f"\n⚙️  Din konfigurationsfil ({cfg_path}) förväntar sig:", file=sys.stderr)
+        for env_var_name in required_env_vars:
+            print(f"  - {env_var_name}", file=sys.stderr)
+        
+        return False
+    return True
+
 def main():
     logging.basicConfig(
         level=logging.INFO,
@@ -587,6 +3235,10 @@ def main():
         datefmt="%Y-%m-%d %H:%M:%S",
     )
     
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        sys.exit(bench_main(sys.argv[2:]))
+    check_only = "--check-config" in sys.argv[1:]
+
     cfg_path = os.environ.get("GENIO_CONFIG", "config.yaml")
     
     try:
@@ -598,55 +3250,15 @@ def main():
 
         cfg = load_config(cfg_path)
         
-        # Validate environment variables (only check names, never log values)
-        # Note: We only log environment variable NAMES (e.g., "MQTT_PASSWORD"),
-        # never the actual sensitive values
-        required_env_vars = [
-            cfg["wakeword"]["access_key_env"],
-            cfg["mqtt"]["username_env"],
-            cfg["mqtt"]["password_env"]
-        ]
-        
-        missing_vars = []
-        empty_vars = []
-        for env_var_name in required_env_vars:
-            value = os.environ.get(env_var_name)
-            if value is None:
-                missing_vars.append(env_var_name)
-            elif not value.strip():
-                empty_vars.append(env_var_name)
-        
-        if missing_vars or empty_vars:
-            all_invalid = missing_vars + empty_vars
-            # Safe: Log only variable names, not values
-            logging.error(f"Saknade eller tomma miljövariabler: {', '.join(all_invalid)}")
-            print(f"\n❌ Följande miljövariabler måste sättas korrekt:", file=sys.stderr)
-            for env_var_name in all_invalid:
-                # Safe: Only printing variable name, no sensitive data
-                if env_var_name in missing_vars:
-                    print(f"  - {env_var_name} (inte satt i miljön)", file=sys.stderr)
-                else:
-                    print(f"  - {env_var_name} (tom eller endast whitespace)", file=sys.stderr)
-            
-            print(f"\n💡 Felsökning:", file=sys.stderr)
-            print(f"  1. Kontrollera att du stavat variabelnamnen rätt", file=sys.stderr)
-            # Safe: At least one list is non-empty due to condition on line 570
-            first_var = missing_vars[0] if missing_vars else empty_vars[0]
-            print(f"  2. Kör 'echo ${first_var}' för att verifiera värdet", file=sys.stderr)
-            print(f"  3. Exportera variabler i SAMMA terminal där du kör scriptet", file=sys.stderr)
-            
-            print(f"\n📝 Exempel på korrekt användning:", file=sys.stderr)
-            print(f"  export PORCUPINE_ACCESS_KEY=\"your_key_here\"", file=sys.stderr)
-            print(f"  export MQTT_USERNAME=\"your_username\"", file=sys.stderr)
-            print(f"  export MQTT_PASSWORD=\"your_password\"", file=sys.stderr)
-            print(f"  python3 genio_ai.py", file=sys.stderr)
-            
-            print(f"\n⚙️  Din konfigurationsfil ({cfg_path}) förväntar sig:", file=sys.stderr)
-            for env_var_name in required_env_vars:
-                print(f"  - {env_var_name}", file=sys.stderr)
-            
+        if not check_environment(cfg, cfg_path):
             sys.exit(1)
-        
+
+        if check_only:
+            build_config_components(cfg)
+            # Inga native-bibliotek har laddats hit, så kontrollen tar millisekunder
+            logging.info(f"Konfigurationen {cfg_path} är giltig")
+            sys.exit(0)
+
         app = GenioAIApp(cfg)
         app.run()
         
@@ -7,7 +7,7 @@ import os
 import sys
 from pathlib import Path
 import yaml
-import importlib
+import importlib.util
 
 def check_file(path: str, description: str) -> bool:
     """Check if a file exists."""
@@ -107,10 +107,14 @@ def check_dependencies():
     
     all_ok = True
     for module_name in required_modules:
+        # find_spec letar bara upp modulen, utan att ladda Whisper/PortAudio m.fl.
         try:
-            importlib.import_module(module_name)
-            print(f"✅ {module_name}")
+            found = importlib.util.find_spec(module_name) is not None
         except ImportError:
+            found = False
+        if found:
+            print(f"✅ {module_name}")
+        else:
             print(f"❌ {module_name} saknas")
             all_ok = False
     
@@ -152,8 +156,10 @@ def main():
         
         # Wakeword
         wakeword_cfg = cfg.get("wakeword", {})
-        if not check_file(wakeword_cfg.get("keyword_path", ""), "Wakeword (.ppn)"):
-            all_checks_ok = False
+        keywords = wakeword_cfg.get("keywords") or [{"path": wakeword_cfg.get("keyword_path", "")}]
+        for kw in keywords:
+            if not check_file(kw.get("path", ""), "Wakeword (.ppn)"):
+                all_checks_ok = False
         
         model_path = wakeword_cfg.get("model_path")
         if model_path: